@@ -0,0 +1,146 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+"""Generic caches
+
+In-memory LRU and sqlite-backed key/value stores shared by the modules that
+need to memoize expensive results (digests, mimetypes...).
+"""
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+
+# ===========
+#  LRU cache
+# ===========
+
+class LRUCache(object):
+    """Thread-safe in-memory least recently used cache
+
+    Hit and miss counters are kept to help sizing the cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: maximum number of entries kept in the cache
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be a positive integer")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value cached for key and mark it as recently used"""
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache value for key, evicting the least recently used entry"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove key from the cache if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry and reset counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# ==============
+#  sqlite cache
+# ==============
+
+class SQLiteCache(object):
+    """Persistent key/value cache stored in a sqlite database
+
+    Keys and values are stored as text, callers are responsible for their
+    serialization.
+    """
+
+    def __init__(self, path, table="cache"):
+        """
+        :param path: path of the sqlite database file
+        :param table: name of the table storing the entries
+        """
+        self.path = path
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS {0} "
+                               "(key TEXT PRIMARY KEY, value TEXT)"
+                               "".format(self._table))
+
+    def get(self, key, default=None):
+        """Return the value stored for key"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM {0} WHERE key = ?"
+                                     "".format(self._table),
+                                     (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set(self, key, value):
+        """Store value for key, replacing any previous value"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO {0} (key, value) "
+                                   "VALUES (?, ?)".format(self._table),
+                                   (key, value))
+
+    def invalidate(self, key):
+        """Remove key from the database if present"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM {0} WHERE key = ?"
+                                   "".format(self._table), (key,))
+
+    def clear(self):
+        """Remove every entry"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM {0}".format(self._table))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
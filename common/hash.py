@@ -18,6 +18,145 @@
 One should use this module instead of hashlib
 """
 import hashlib
+import mmap
+import os
+import stat
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from common.cache import LRUCache, SQLiteCache
+from common.compat import basestring
+
+try:
+    # python 2: mmap objects only expose the old buffer interface
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+# ==================
+#  internal helpers
+# ==================
+
+def _new_handles(algorithms):
+    """instantiate hashlib handles indexed by algorithm name
+
+    :param algorithms: list of hashlib algorithm names (or constructors)
+    :return: dict mapping each algorithm name to a fresh handle
+    """
+    handles = dict()
+    for algorithm in algorithms:
+        if callable(algorithm):
+            handle = algorithm()
+            handles[handle.name.lower()] = handle
+        else:
+            handles[algorithm] = hashlib.new(algorithm)
+    return handles
+
+
+def _chunk_size(handles):
+    """chunk size used to feed handles, a multiple of their block_size"""
+    return 4096 * max(handle.block_size for handle in handles)
+
+
+def _update_from_fileobj(handles, fileobj, chunk_size):
+    """feed every handle with the content of fileobj
+
+    When the file object supports ``readinto``, a single buffer is reused
+    for the whole stream instead of allocating a new bytes per chunk.
+
+    :return: number of bytes read
+    """
+    total = 0
+    readinto = getattr(fileobj, 'readinto', None)
+    if readinto is None:
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            for handle in handles:
+                handle.update(chunk)
+            total += len(chunk)
+        return total
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        size = readinto(buf)
+        if not size:
+            break
+        chunk = view[:size]
+        for handle in handles:
+            handle.update(chunk)
+        total += size
+    return total
+
+
+def _update_from_path(handles, path, chunk_size):
+    """feed every handle with the content of the file at path
+
+    Regular files are memory-mapped and fed by zero-copy slices, anything
+    that can not be mapped (empty files, pipes, devices) is read through
+    ``_update_from_fileobj``.
+    """
+    with open(path, 'rb') as fileobj:
+        mapped = None
+        fileno = fileobj.fileno()
+        if stat.S_ISREG(os.fstat(fileno).st_mode):
+            try:
+                mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                mapped = None
+        if mapped is None:
+            _update_from_fileobj(handles, fileobj, chunk_size)
+            return
+        try:
+            for offset in range(0, len(mapped), chunk_size):
+                chunk = _buffer(mapped, offset, chunk_size)
+                for handle in handles:
+                    handle.update(chunk)
+                del chunk
+        finally:
+            mapped.close()
+
+
+def _hexdigest(item, algorithm, cache=None):
+    """compute digest of a path or of a file object (rewound after use)"""
+    if cache is not None and isinstance(item, basestring):
+        return cache.hexdigest(item, algorithm)
+    handle = list(_new_handles([algorithm]).values())[0]
+    if isinstance(item, basestring):
+        _update_from_path([handle], item, _chunk_size([handle]))
+    else:
+        item.seek(0)
+        _update_from_fileobj([handle], item, _chunk_size([handle]))
+        item.seek(0)
+    return handle.hexdigest()
+
+
+_DONE = object()
+
+
+def _put(fifo, value, stop, interval=0.1):
+    """put value in a bounded fifo unless stop is set while waiting"""
+    while not stop.is_set():
+        try:
+            fifo.put(value, timeout=interval)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(fifo, stop, interval=0.1):
+    """get a value from fifo, or _DONE if stop is set while waiting"""
+    while not stop.is_set():
+        try:
+            return fifo.get(timeout=interval)
+        except queue.Empty:
+            continue
+    return _DONE
 
 
 # ====================
@@ -39,13 +178,287 @@ def generic_sum(algorithm):
         """
         fileobj.seek(0)
         handle = algorithm()
-        for chunk in iter(lambda: fileobj.read(4096 * handle.block_size), b''):
-            handle.update(chunk)
+        _update_from_fileobj([handle], fileobj, _chunk_size([handle]))
         fileobj.seek(0)
         return handle.hexdigest()
     return hash_sum
 
 
+def generic_sum_path(algorithm):
+    """compute digest of a file on disk based on algorithm passed in parameter
+
+    :param algorithm: hashlib algorithm to use
+    :return: digest returned by the algorithm
+    """
+
+    def hash_sum_path(path):
+        """compute digest of the file at path, memory-mapping it if possible
+
+        :param path: path of the file to hash
+        """
+        handle = algorithm()
+        _update_from_path([handle], path, _chunk_size([handle]))
+        return handle.hexdigest()
+    return hash_sum_path
+
+
+def multisum(fileobj, algorithms=('md5', 'sha1', 'sha256')):
+    """compute several digests while reading fileobj only once
+
+    Every chunk read from the file object is fed to all the hashlib handles,
+    so asking for n digests costs a single pass over the data instead of n.
+
+    :param fileobj:  Open file(-like) object (BytesIO buffer)
+       Note that fileobj will be returned after a seek(0)
+    :param algorithms: list of hashlib algorithm names (or constructors)
+    :return: dict mapping each algorithm name to its hexdigest
+    """
+    handles = _new_handles(algorithms)
+    if not handles:
+        return dict()
+    fileobj.seek(0)
+    _update_from_fileobj(handles.values(), fileobj,
+                         _chunk_size(handles.values()))
+    fileobj.seek(0)
+    return dict((name, handle.hexdigest())
+                for name, handle in handles.items())
+
+
+def multisum_path(path, algorithms=('md5', 'sha1', 'sha256')):
+    """compute several digests of a file on disk in a single pass
+
+    :param path: path of the file to hash
+    :param algorithms: list of hashlib algorithm names (or constructors)
+    :return: dict mapping each algorithm name to its hexdigest
+    """
+    handles = _new_handles(algorithms)
+    if not handles:
+        return dict()
+    _update_from_path(handles.values(), path, _chunk_size(handles.values()))
+    return dict((name, handle.hexdigest())
+                for name, handle in handles.items())
+
+
+def hash_many(items, algorithm, workers=4, cache=None):
+    """compute digests of many files concurrently
+
+    Items are hashed by a pool of threads (hashlib releases the GIL while
+    digesting large buffers) using the same chunking as ``generic_sum``, so
+    digests are identical to the single file helpers. At most ``workers``
+    items are queued and ``workers`` results pending at any time, which
+    bounds the memory used whatever the size of ``items``.
+
+    :param items: iterable of paths or open file(-like) objects
+       Note that file objects will be returned after a seek(0)
+    :param algorithm: hashlib algorithm to use (name or constructor)
+    :param workers: number of hashing threads
+    :param cache: optional ``DigestCache`` used for paths
+    :return: generator of (item, hexdigest) tuples in completion order
+    """
+    if workers < 1:
+        raise ValueError("workers must be a positive integer")
+    tasks = queue.Queue(maxsize=workers)
+    results = queue.Queue(maxsize=workers)
+    stop = threading.Event()
+
+    def feed():
+        try:
+            for item in items:
+                if not _put(tasks, item, stop):
+                    return
+        except Exception as error:
+            _put(results, (None, None, error), stop)
+        finally:
+            for _ in range(workers):
+                _put(tasks, _DONE, stop)
+
+    def work():
+        while True:
+            item = _get(tasks, stop)
+            if item is _DONE:
+                break
+            try:
+                result = (item, _hexdigest(item, algorithm, cache), None)
+            except Exception as error:
+                result = (item, None, error)
+            if not _put(results, result, stop):
+                break
+        _put(results, _DONE, stop)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = workers
+    try:
+        while running:
+            result = results.get()
+            if result is _DONE:
+                running -= 1
+                continue
+            item, digest, error = result
+            if error is not None:
+                raise error
+            yield item, digest
+    finally:
+        stop.set()
+
+
+# ===================
+#  Streaming hashing
+# ===================
+
+class Hasher(object):
+    """Incremental hasher fed with chunks as they arrive
+
+    Instances can be passed directly as data callback (e.g. to
+    ``ftplib.FTP.retrbinary``) so the digest is computed while the data is
+    transferred instead of in a second pass over the complete file.
+
+        .. code-block:: python
+
+            hasher = Hasher()
+            ftp.retrbinary("RETR sample", hasher)
+            print(hasher.hexdigest(), hasher.size)
+
+    """
+
+    def __init__(self, algorithms=('sha256',)):
+        """
+        :param algorithms: list of hashlib algorithm names (or constructors)
+        """
+        self._handles = _new_handles(algorithms)
+        if not self._handles:
+            raise ValueError("at least one algorithm is required")
+        self.size = 0
+
+    def __call__(self, chunk):
+        self.update(chunk)
+
+    @property
+    def algorithms(self):
+        return sorted(self._handles.keys())
+
+    def update(self, chunk):
+        """feed a chunk of data to every algorithm
+
+        :param chunk: bytes-like object
+        """
+        for handle in self._handles.values():
+            handle.update(chunk)
+        self.size += len(chunk)
+
+    def update_from_fileobj(self, fileobj):
+        """feed the remaining content of a file object (no seek is done)
+
+        :param fileobj: Open file(-like) object
+        :return: number of bytes read
+        """
+        handles = list(self._handles.values())
+        size = _update_from_fileobj(handles, fileobj, _chunk_size(handles))
+        self.size += size
+        return size
+
+    def copy(self):
+        """return a snapshot of the hasher that can be fed independently"""
+        hasher = Hasher.__new__(Hasher)
+        hasher._handles = dict((name, handle.copy())
+                               for name, handle in self._handles.items())
+        hasher.size = self.size
+        return hasher
+
+    def hexdigest(self, algorithm=None):
+        """return digest of the data fed so far
+
+        :param algorithm: name of the algorithm, may be omitted if the
+           hasher only computes one digest
+        """
+        if algorithm is None:
+            if len(self._handles) != 1:
+                raise ValueError("algorithm must be given when several "
+                                 "digests are computed")
+            algorithm = list(self._handles.keys())[0]
+        return self._handles[algorithm].hexdigest()
+
+    def hexdigests(self):
+        """return dict mapping each algorithm name to its hexdigest"""
+        return dict((name, handle.hexdigest())
+                    for name, handle in self._handles.items())
+
+
+# ==============
+#  Digest cache
+# ==============
+
+class DigestCache(object):
+    """Cache of digests for files on disk
+
+    Digests are indexed by (device, inode, size, mtime) of the file so any
+    modification of the file invalidates its entries. Lookups go through an
+    in-memory LRU tier then, if a path is given, through a sqlite database
+    persisting digests across processes.
+    """
+
+    def __init__(self, maxsize=4096, path=None):
+        """
+        :param maxsize: number of digests kept in memory
+        :param path: optional path of the sqlite database
+        """
+        self.memory = LRUCache(maxsize)
+        self.disk = None
+        if path is not None:
+            self.disk = SQLiteCache(path, table="digests")
+
+    @staticmethod
+    def _key(st, algorithm):
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 10 ** 9)
+        name = list(_new_handles([algorithm]).keys())[0]
+        return "{0}:{1}:{2}:{3}:{4}".format(st.st_dev, st.st_ino,
+                                            st.st_size, mtime_ns, name)
+
+    def hexdigest(self, path, algorithm='sha256'):
+        """return digest of the file at path, computing it on cache miss
+
+        :param path: path of the file to hash
+        :param algorithm: hashlib algorithm to use (name or constructor)
+        :return: digest returned by the algorithm
+        """
+        key = self._key(os.stat(path), algorithm)
+        digest = self.memory.get(key)
+        if digest is not None:
+            return digest
+        if self.disk is not None:
+            digest = self.disk.get(key)
+            if digest is not None:
+                self.memory.set(key, digest)
+                return digest
+        handle = list(_new_handles([algorithm]).values())[0]
+        _update_from_path([handle], path, _chunk_size([handle]))
+        digest = handle.hexdigest()
+        # do not cache a digest if the file changed while being hashed
+        if self._key(os.stat(path), algorithm) == key:
+            self.memory.set(key, digest)
+            if self.disk is not None:
+                self.disk.set(key, digest)
+        return digest
+
+    def invalidate(self, path, algorithm='sha256'):
+        """forget the digest cached for the current state of path"""
+        key = self._key(os.stat(path), algorithm)
+        self.memory.invalidate(key)
+        if self.disk is not None:
+            self.disk.invalidate(key)
+
+    def clear(self):
+        """forget every cached digest"""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
 # ==========================
 #  declare digest functions
 # ==========================
@@ -62,3 +475,16 @@ sha384sum = generic_sum(hashlib.sha384)
 """use ``generic_sum`` to compute sha384 digest"""
 sha512sum = generic_sum(hashlib.sha512)
 """use ``generic_sum`` to compute sha512 digest"""
+
+md5sum_path = generic_sum_path(hashlib.md5)
+"""use ``generic_sum_path`` to compute md5 digest"""
+sha1sum_path = generic_sum_path(hashlib.sha1)
+"""use ``generic_sum_path`` to compute sha1 digest"""
+sha224sum_path = generic_sum_path(hashlib.sha224)
+"""use ``generic_sum_path`` to compute sha224 digest"""
+sha256sum_path = generic_sum_path(hashlib.sha256)
+"""use ``generic_sum_path`` to compute sha256 digest"""
+sha384sum_path = generic_sum_path(hashlib.sha384)
+"""use ``generic_sum_path`` to compute sha384 digest"""
+sha512sum_path = generic_sum_path(hashlib.sha512)
+"""use ``generic_sum_path`` to compute sha512 digest"""
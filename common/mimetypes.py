@@ -19,68 +19,209 @@ This wrapper handles python-magic api changes
 """
 import magic
 import os
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from common.cache import LRUCache, SQLiteCache
+from common.compat import unicode
+from common.hash import Hasher
+
+
+class MimetypeCache(object):
+    """Cache of mimetypes indexed by content digest
+
+    Results are kept in an in-memory LRU tier and, if a path is given,
+    persisted in a sqlite database. Hit and miss counters cover both tiers.
+    """
+
+    def __init__(self, maxsize=4096, path=None):
+        """
+        :param maxsize: number of mimetypes kept in memory
+        :param path: optional path of the sqlite database
+        """
+        self.memory = LRUCache(maxsize)
+        self.disk = None
+        if path is not None:
+            self.disk = SQLiteCache(path, table="mimetypes")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(digest, magic_file, flags):
+        return "{0}:{1}:{2}".format(digest, flags, magic_file or "")
+
+    def get(self, key):
+        """Return the mimetype cached for key or None"""
+        filetype = self.memory.get(key)
+        if filetype is None and self.disk is not None:
+            filetype = self.disk.get(key)
+            if filetype is not None:
+                self.memory.set(key, filetype)
+        with self._lock:
+            if filetype is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return filetype
+
+    def set(self, key, filetype):
+        """Cache mimetype for key"""
+        self.memory.set(key, filetype)
+        if self.disk is not None:
+            self.disk.set(key, filetype)
+
+    def clear(self):
+        """Forget every cached mimetype and reset counters"""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
 
 
 class Magic(object):
-    """Factory class for python-magic"""
+    """Factory class for python-magic
+
+    Loading a magic database is expensive, so cookies are kept in a pool
+    indexed by (magic_file, flags): each database is loaded once per
+    concurrent user and cookies are never shared between two threads.
+    """
+
+    old_api = None
+    # optional MimetypeCache, see enable_cache
+    cache = None
+    _cookies = dict()
+    _lock = threading.Lock()
 
     # ==================
     #  internal helpers
     # ==================
 
+    @classmethod
+    def _flags(cls, mime=False, mime_encoding=False, keep_going=False):
+        """Compute libmagic flags"""
+        flags = magic.MAGIC_NONE
+        if mime:
+            flags |= magic.MAGIC_MIME
+        if mime_encoding:
+            flags |= magic.MAGIC_MIME_ENCODING
+        if keep_going:
+            flags |= magic.MAGIC_CONTINUE
+        return flags
+
     @classmethod
     def _initialize(cls,
                     magic_file=None,
                     mime=False,
                     mime_encoding=False,
                     keep_going=False):
-        """Initialize python-magic"""
-        # setting flags
-        cls.flags = magic.MAGIC_NONE
-        if mime:
-            cls.flags |= magic.MAGIC_MIME
-        if mime_encoding:
-            cls.flags |= magic.MAGIC_MIME_ENCODING
-        if keep_going:
-            cls.flags |= magic.MAGIC_CONTINUE
-        # creating cookie
-        cls.old_api = True
+        """Create a new python-magic cookie"""
+        flags = cls._flags(mime, mime_encoding, keep_going)
         try:
             # using the old API
-            cls.cookie = magic.open(cls.flags)
+            cookie = magic.open(flags)
             # load database
             if magic_file and os.path.exists(magic_file):
-                cls.cookie.load(magic_file)
+                cookie.load(magic_file)
             else:
-                cls.cookie.load()
+                cookie.load()
+            cls.old_api = True
         except AttributeError:
             cls.old_api = False
-            cls.cookie = magic.Magic(mime=mime,
-                                     magic_file=magic_file,
-                                     mime_encoding=mime_encoding,
-                                     keep_going=keep_going)
-            cls.cookie.file = cls.cookie.from_file
-            cls.cookie.buffer = cls.cookie.from_buffer
+            cookie = magic.Magic(mime=mime,
+                                 magic_file=magic_file,
+                                 mime_encoding=mime_encoding,
+                                 keep_going=keep_going)
+            cookie.file = cookie.from_file
+            cookie.buffer = cookie.from_buffer
+        return cookie
+
+    @classmethod
+    def _acquire(cls, **kwargs):
+        """Get an idle cookie from the pool, creating one if needed
+
+        :return: tuple (key, cookie), key must be given back to ``_release``
+        """
+        key = (kwargs.get('magic_file', None),
+               cls._flags(kwargs.get('mime', False),
+                          kwargs.get('mime_encoding', False),
+                          kwargs.get('keep_going', False)))
+        with cls._lock:
+            idle = cls._cookies.setdefault(key, [])
+            if idle:
+                return key, idle.pop()
+        # database loading is done outside the lock
+        return key, cls._initialize(**kwargs)
+
+    @classmethod
+    def _release(cls, key, cookie):
+        """Give back a cookie to the pool"""
+        with cls._lock:
+            cls._cookies.setdefault(key, []).append(cookie)
+
+    @classmethod
+    def _process(cls, method, data, **kwargs):
+        """Run cookie method on data with a pooled cookie"""
+        key, cookie = cls._acquire(**kwargs)
+        try:
+            filetype = getattr(cookie, method)(data)
+        except magic.MagicException:
+            # should never enter here, but in case of
+            filetype = None
+        finally:
+            cls._release(key, cookie)
+        return filetype
 
     # ================
     #  Public methods
     # ================
 
     @classmethod
-    def from_buffer(cls, buf, **kwargs):
+    def enable_cache(cls, maxsize=4096, path=None):
+        """Cache results of ``from_buffer`` by content digest
+
+        :param maxsize: number of mimetypes kept in memory
+        :param path: optional path of a sqlite database to persist results
+        :return: the MimetypeCache in use
+        """
+        cls.cache = MimetypeCache(maxsize, path)
+        return cls.cache
+
+    @classmethod
+    def disable_cache(cls):
+        cls.cache = None
+
+    @classmethod
+    def from_buffer(cls, buf, digest=None, **kwargs):
         """Compute mimetype from a buffer
 
         :param buf: buffer from where to get data
+        :param digest: sha256 hexdigest of buf if already known, only used
+            when the cache is enabled (computed otherwise)
         """
-        cls._initialize(**kwargs)
-        # perform processing
-        try:
-            filetype = cls.cookie.buffer(buf)
-            if cls.old_api:
-                cls.cookie.close()
-        except magic.MagicException:
-            # should never enter here, but in case of
-            filetype = None
+        cache = cls.cache
+        if cache is None:
+            return cls._process('buffer', buf, **kwargs)
+        if digest is None:
+            hasher = Hasher(['sha256'])
+            if isinstance(buf, unicode):
+                hasher.update(buf.encode('utf8'))
+            else:
+                hasher.update(buf)
+            digest = hasher.hexdigest()
+        key = cache.key(digest,
+                        kwargs.get('magic_file', None),
+                        cls._flags(kwargs.get('mime', False),
+                                   kwargs.get('mime_encoding', False),
+                                   kwargs.get('keep_going', False)))
+        filetype = cache.get(key)
+        if filetype is None:
+            filetype = cls._process('buffer', buf, **kwargs)
+            if filetype is not None:
+                cache.set(key, filetype)
         return filetype
 
     @classmethod
@@ -89,14 +230,41 @@ class Magic(object):
 
         :param filename: name of a file from where to get data
         """
-        # reconfigure class before processing
-        cls._initialize(**kwargs)
-        # perform processing
+        return cls._process('file', filename, **kwargs)
+
+    @classmethod
+    def from_files(cls, filenames, workers=4, head_bytes=None, **kwargs):
+        """Compute mimetypes of several files in parallel
+
+        Detection is done by a pool of threads using pooled cookies, with
+        ``from_file`` by default. If ``head_bytes`` is given, only this
+        prefix of each file is read and detected with ``from_buffer``,
+        which uses the cache if enabled. Results may then differ from
+        ``from_file``: some checks of libmagic (ELF sections for instance)
+        need to seek in the whole file.
+
+        :param filenames: list of names of files from where to get data
+        :param workers: number of detection threads
+        :param head_bytes: optional size of the prefix read from each file
+        :return: list of mimetypes in the same order as filenames, None for
+            files that could not be read
+        """
+        def detect(filename):
+            try:
+                with open(filename, 'rb') as fileobj:
+                    if head_bytes is None:
+                        return cls.from_file(filename, **kwargs)
+                    buf = fileobj.read(head_bytes)
+            except EnvironmentError:
+                return None
+            return cls.from_buffer(buf, **kwargs)
+
+        filenames = list(filenames)
+        if workers <= 1 or len(filenames) <= 1:
+            return [detect(filename) for filename in filenames]
+        pool = ThreadPool(min(workers, len(filenames)))
         try:
-            filetype = cls.cookie.file(filename)
-            if cls.old_api:
-                cls.cookie.close()
-        except magic.MagicException:
-            # should never enter here, but in case of
-            filetype = None
-        return filetype
+            return pool.map(detect, filenames)
+        finally:
+            pool.close()
+            pool.join()
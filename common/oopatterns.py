@@ -17,6 +17,7 @@
 
 One should re-use these instead of defining their owns.
 """
+import threading
 
 
 # ==========================
@@ -82,6 +83,11 @@ class ParametricSingletonMetaClass(type):
     """
 
     _instances = {}
+    # guards _instances and _locks, never held while building an instance
+    _lock = threading.Lock()
+    # lock of each (class, key) being built, so that concurrent threads get
+    # the same instance without blocking construction of other ones
+    _locks = {}
 
     def __call__(mcs, *args, **kwargs):
         # check for "depends_on" attribute
@@ -103,14 +109,24 @@ class ParametricSingletonMetaClass(type):
         else:
             key = getattr(mcs, "depends_on")(mcs, args, kwargs)
 
-        # check for instance
-        if mcs not in mcs._instances:
-            mcs._instances[mcs] = {}
-        if key not in mcs._instances[mcs]:
-            mcs._instances[mcs][key] = \
-                super(ParametricSingletonMetaClass, mcs).\
+        # check for instance, creating it once even with concurrent threads
+        meta = ParametricSingletonMetaClass
+        with meta._lock:
+            instances = mcs._instances.setdefault(mcs, {})
+            if key in instances:
+                return instances[key]
+            # reentrant as a constructor may use its own class
+            lock = meta._locks.setdefault((mcs, key), threading.RLock())
+        with lock:
+            with meta._lock:
+                if key in instances:
+                    return instances[key]
+            instance = super(ParametricSingletonMetaClass, mcs).\
                 __call__(*args, **kwargs)
-        return mcs._instances[mcs][key]
+            with meta._lock:
+                instances[key] = instance
+                meta._locks.pop((mcs, key), None)
+            return instance
 
     def update_key(mcs, old_key, new_key):
         mcs._instances[mcs][new_key] = mcs._instances[mcs].pop(old_key)
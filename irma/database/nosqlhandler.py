@@ -14,12 +14,27 @@
 # terms contained in the LICENSE file.
 
 import logging
+import functools
+import threading
 from time import sleep
 import gridfs
 
-from pymongo import MongoClient
+try:
+    from gridfs import GridFSBucket
+except ImportError:  # pymongo < 3.1
+    GridFSBucket = None
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import AutoReconnect, ConnectionFailure
+from pymongo.errors import DuplicateKeyError
 
-from common.oopatterns import Singleton
+try:
+    from pymongo import ReplaceOne, UpdateOne, DeleteOne
+except ImportError:  # pymongo < 3.0, use legacy bulk operations
+    ReplaceOne = UpdateOne = DeleteOne = None
+
+from common.hash import Hasher
+from common.oopatterns import ParametricSingleton
 from irma.common.exceptions import IrmaDatabaseError
 
 log = logging.getLogger(__name__)
@@ -27,40 +42,121 @@ log = logging.getLogger(__name__)
 
 def retry_connect(func):
     """Decorator for NoSQLDatabase to retry connecting automatically
+
+    Connects if needed, and when the connection to the server is lost
+    during the call, reconnects and retries it with a bounded exponential
+    backoff (see ``retries``, ``retry_delay`` and ``max_retry_delay``).
     """
+    @functools.wraps(func)
     def wrapper(instance, *args, **kwargs):
-        if isinstance(instance, NoSQLDatabase):
+        if not isinstance(instance, NoSQLDatabase):
+            raise NotImplementedError()
+        attempt = 0
+        while True:
             if not instance._is_connected():
-                try:
-                    instance._connect()
-                    return func(instance, *args, **kwargs)
-                except IrmaDatabaseError as e:
-                    raise e
-            return func(instance, *args, **kwargs)
-        else:
+                instance._connect()
+            conn = instance._db_conn
+            try:
+                return func(instance, *args, **kwargs)
+            except ConnectionFailure as e:
+                if attempt >= instance._retries:
+                    raise IrmaDatabaseError("{0}".format(e))
+                delay = instance._backoff(attempt)
+                log.warn("Connection to database lost ({0}), retrying "
+                         "in {1}s".format(e, delay))
+                sleep(delay)
+                instance._reset(conn)
+                attempt += 1
+    return wrapper
+
+
+def auto_connect(func):
+    """Decorator for NoSQLDatabase to connect automatically, without retry
+
+    For operations that are not idempotent, which must not be replayed:
+    when the connection is lost during the call, the operation may have
+    been applied or not, so IrmaDatabaseError is raised and only the next
+    call reconnects.
+    """
+    @functools.wraps(func)
+    def wrapper(instance, *args, **kwargs):
+        if not isinstance(instance, NoSQLDatabase):
             raise NotImplementedError()
+        if not instance._is_connected():
+            instance._connect()
+        conn = instance._db_conn
+        try:
+            return func(instance, *args, **kwargs)
+        except ConnectionFailure as e:
+            instance._reset(conn)
+            raise IrmaDatabaseError("{0}".format(e))
     return wrapper
 
 
+class _HashingReader(object):
+    """File object wrapper computing the sha256 of the data read"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = Hasher(['sha256'])
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+
 # TODO: Create an abstract class so we can use multiple databases,
 # not only mongodb
-class NoSQLDatabase(Singleton):
+class NoSQLDatabase(ParametricSingleton):
     """Internal database.
 
     This class handles the creation of the internal database and provides some
     functions for interacting with it.
+
+    There is one instance per (db_uri, db_name), sharing the connection pool
+    of its client between threads. Options of the first instantiation for a
+    given key are the ones kept.
     """
 
+    # ============================
+    #  parametric singleton stuff
+    # ============================
+
+    @staticmethod
+    def depends_on(cls, *args, **kwargs):
+        # singleton depends on the uri and name of the database
+        params = dict(zip(('db_name', 'db_uri'), args[0]))
+        params.update(args[1])
+        return (params.get('db_uri'), params.get('db_name'))
+
     # ==================================
     #  Constructor and Destructor stuff
     # ==================================
-    def __init__(self, db_name, db_uri):
+    def __init__(self, db_name, db_uri, retries=3, retry_delay=0.5,
+                 max_retry_delay=10, **client_options):
+        """
+        :param db_name: name of the database
+        :param db_uri: mongodb uri of the server
+        :param retries: number of reconnections attempted when connecting
+            fails or when the connection is lost during an operation
+        :param retry_delay: delay in seconds before the first retry, doubled
+            on each following one
+        :param max_retry_delay: upper bound of the delay between retries
+        :param client_options: options of the MongoClient, e.g. maxPoolSize,
+            minPoolSize, connectTimeoutMS, socketTimeoutMS,
+            serverSelectionTimeoutMS or waitQueueTimeoutMS
+        """
         # TODO: Get defaults from configuration file
         self._db_name = db_name
         self._db_uri = db_uri
         self._db_conn = None
-        self._db_cache = dict()
-        self._coll_cache = dict()
+        self._clear_caches()
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._client_options = client_options
+        self._lock = threading.RLock()
         self._connect()
 
     def __del__(self):
@@ -77,47 +173,202 @@ class NoSQLDatabase(Singleton):
     #  Private methods
     # =================
 
+    def _backoff(self, attempt):
+        return min(self._retry_delay * 2 ** attempt, self._max_retry_delay)
+
     def _connect(self):
-        if self._db_conn:
-            log.warn("Already connected to database")
-        try:
-            self._db_conn = MongoClient(self._db_uri)
-        except Exception as e:
-            raise IrmaDatabaseError("{0}".format(e))
+        with self._lock:
+            if self._db_conn:
+                log.warn("Already connected to database")
+                return
+            attempt = 0
+            while True:
+                try:
+                    self._db_conn = MongoClient(self._db_uri,
+                                                **self._client_options)
+                    return
+                except Exception as e:
+                    if attempt >= self._retries:
+                        raise IrmaDatabaseError("{0}".format(e))
+                    delay = self._backoff(attempt)
+                    log.warn("Failed to connect to database ({0}), "
+                             "retrying in {1}s".format(e, delay))
+                    sleep(delay)
+                    attempt += 1
 
-    def _disconnect(self):
-        if not self._db_conn:
-            return
-        try:
-            self._db_conn.close()
-            self._db_conn = None
-            self._db_cache = dict()
-            self._coll_cache = dict()
-        except Exception as e:
-            raise IrmaDatabaseError("{0}".format(e))
+    def _clear_caches(self):
+        # database handles by name, collection and gridfs handles by
+        # (db_name, coll_name)
+        self._db_cache = dict()
+        self._coll_cache = dict()
+        self._fs_cache = dict()
+        self._bucket_cache = dict()
+        # (db_name, coll_name) of gridfs with their sha256 index ensured
+        self._dedup_indexed = set()
 
-    def _database(self, db_name):
-        if db_name not in self._db_cache:
+    def _disconnect(self):
+        with self._lock:
+            if not self._db_conn:
+                return
             try:
-                self._db_cache[db_name] = self._db_conn[db_name]
+                self._db_conn.close()
+                self._db_conn = None
+                self._clear_caches()
             except Exception as e:
                 raise IrmaDatabaseError("{0}".format(e))
-        return self._db_cache[db_name]
+
+    def _reset(self, conn):
+        """Drop connection conn if it is still the current one"""
+        with self._lock:
+            if self._db_conn is not conn:
+                # already replaced by another thread
+                return
+            try:
+                self._disconnect()
+            except IrmaDatabaseError:
+                self._db_conn = None
+                self._clear_caches()
+
+    def _database(self, db_name):
+        with self._lock:
+            if self._db_conn is None:
+                # reset by another thread, retry_connect reconnects
+                raise AutoReconnect("not connected to database")
+            if db_name not in self._db_cache:
+                try:
+                    self._db_cache[db_name] = self._db_conn[db_name]
+                except Exception as e:
+                    raise IrmaDatabaseError("{0}".format(e))
+            return self._db_cache[db_name]
 
     def _table(self, db_name, coll_name):
         database = self._database(db_name)
-        # TODO: Fix collision if two tables
-        # from different databases have the same name
-        if coll_name not in self._coll_cache:
-            try:
-                self._coll_cache[coll_name] = database[coll_name]
-            except Exception as e:
-                raise IrmaDatabaseError("{0}".format(e))
-        return self._coll_cache[coll_name]
+        key = (db_name, coll_name)
+        with self._lock:
+            if key not in self._coll_cache:
+                try:
+                    self._coll_cache[key] = database[coll_name]
+                except Exception as e:
+                    raise IrmaDatabaseError("{0}".format(e))
+            return self._coll_cache[key]
+
+    def _gridfs(self, db_name, coll_name):
+        """Return the GridFS of collection coll_name, created once"""
+        database = self._database(db_name)
+        key = (db_name, coll_name)
+        with self._lock:
+            if key not in self._fs_cache:
+                try:
+                    self._fs_cache[key] = gridfs.GridFS(database,
+                                                        collection=coll_name)
+                except Exception as e:
+                    raise IrmaDatabaseError("{0}".format(e))
+            return self._fs_cache[key]
+
+    def _gridfs_bucket(self, db_name, coll_name):
+        """Return the GridFSBucket of collection coll_name, created once
+
+        None if the installed pymongo does not provide buckets.
+        """
+        if GridFSBucket is None:
+            return None
+        database = self._database(db_name)
+        key = (db_name, coll_name)
+        with self._lock:
+            if key not in self._bucket_cache:
+                try:
+                    self._bucket_cache[key] = \
+                        GridFSBucket(database, bucket_name=coll_name)
+                except Exception as e:
+                    raise IrmaDatabaseError("{0}".format(e))
+            return self._bucket_cache[key]
+
+    def _dedup_files(self, db_name, coll_name):
+        """Return files collection of gridfs coll_name, indexed by sha256
+
+        The unique index is sparse so that files stored without
+        deduplication, which have no sha256, can share the collection.
+        """
+        files = self._table(db_name, coll_name + ".files")
+        key = (db_name, coll_name)
+        with self._lock:
+            if key not in self._dedup_indexed:
+                files.create_index([("sha256", ASCENDING)],
+                                   unique=True, sparse=True)
+                self._dedup_indexed.add(key)
+        return files
+
+    @staticmethod
+    def _update_one(collection, spec, document):
+        """Update first entry matching spec, return number matched"""
+        if hasattr(collection, 'update_one'):
+            return collection.update_one(spec, document).matched_count
+        return collection.update(spec, document)['n']
+
+    @staticmethod
+    def _add_reference(files, sha256):
+        """Increment reference count of the file with digest sha256
+
+        :return: the file object-id, None if there is no such file
+        """
+        update = {"$inc": {"refcount": 1}}
+        if hasattr(files, 'find_one_and_update'):
+            res = files.find_one_and_update({"sha256": sha256}, update,
+                                            projection={"_id": True})
+        else:
+            res = files.find_and_modify({"sha256": sha256}, update,
+                                        fields={"_id": True})
+        if res is None:
+            return None
+        return res["_id"]
 
     def _is_connected(self):
         return self._db_conn is not None
 
+    @staticmethod
+    def _batches(items, batch_size):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _bulk_write(self, collection, operations, batch_size):
+        """Execute operations as unordered bulk writes of batch_size
+
+        Operations are tuples ('replace', _id, document),
+        ('update', _id, update) or ('remove', _id), replacements being
+        upserts.
+        """
+        for batch in self._batches(operations, batch_size):
+            if ReplaceOne is not None:
+                requests = []
+                for operation in batch:
+                    if operation[0] == 'replace':
+                        requests.append(ReplaceOne({'_id': operation[1]},
+                                                   operation[2],
+                                                   upsert=True))
+                    elif operation[0] == 'update':
+                        requests.append(UpdateOne({'_id': operation[1]},
+                                                  operation[2]))
+                    else:
+                        requests.append(DeleteOne({'_id': operation[1]}))
+                collection.bulk_write(requests, ordered=False)
+            else:
+                bulk = collection.initialize_unordered_bulk_op()
+                for operation in batch:
+                    selector = bulk.find({'_id': operation[1]})
+                    if operation[0] == 'replace':
+                        selector.upsert().replace_one(operation[2])
+                    elif operation[0] == 'update':
+                        selector.update_one(operation[2])
+                    else:
+                        selector.remove_one()
+                bulk.execute()
+
     # ================
     #  Public methods
     # ================
@@ -132,6 +383,8 @@ class NoSQLDatabase(Singleton):
         try:
             res = collection.find_one({'_id': _id})
             return res
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
@@ -142,6 +395,8 @@ class NoSQLDatabase(Singleton):
         try:
             res = collection.find_one({'_id': _id})
             return res is not None
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
@@ -152,6 +407,8 @@ class NoSQLDatabase(Singleton):
         try:
             _id = collection.save(dict_object)
             return _id
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
@@ -164,6 +421,75 @@ class NoSQLDatabase(Singleton):
         collection = self._table(db_name, collection_name)
         try:
             collection.update({"_id": _id}, {"$set": update_dict})
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            raise IrmaDatabaseError("{0}".format(e))
+
+    @retry_connect
+    def bulk_save(self, db_name, collection_name, dict_objects,
+                  batch_size=1000):
+        """ save entries in collection with unordered bulk writes
+
+        Entries without _id get one, as with save.
+
+        :param dict_objects: iterable of entries
+        :param batch_size: maximum number of entries per bulk write
+        :return: list of the _id of the entries
+        """
+        collection = self._table(db_name, collection_name)
+        # iterated twice, and again when retried
+        dict_objects = list(dict_objects)
+        ids = []
+        for dict_object in dict_objects:
+            if dict_object.get('_id') is None:
+                dict_object['_id'] = ObjectId()
+            ids.append(dict_object['_id'])
+        try:
+            self._bulk_write(collection,
+                             (('replace', obj['_id'], obj)
+                              for obj in dict_objects),
+                             batch_size)
+            return ids
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            raise IrmaDatabaseError("{0}".format(e))
+
+    @retry_connect
+    def bulk_update(self, db_name, collection_name, updates,
+                    batch_size=1000):
+        """ update entries in collection with unordered bulk writes
+
+        :param updates: list of (_id, update_dict), the attributes/values
+            of update_dict being set on entry _id
+        :param batch_size: maximum number of updates per bulk write
+        """
+        collection = self._table(db_name, collection_name)
+        try:
+            self._bulk_write(collection,
+                             (('update', _id, {"$set": update_dict})
+                              for (_id, update_dict) in updates),
+                             batch_size)
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            raise IrmaDatabaseError("{0}".format(e))
+
+    @retry_connect
+    def bulk_remove(self, db_name, collection_name, ids, batch_size=1000):
+        """ delete entries in collection with unordered bulk writes
+
+        :param ids: list of the _id of the entries
+        :param batch_size: maximum number of deletions per bulk write
+        """
+        collection = self._table(db_name, collection_name)
+        try:
+            self._bulk_write(collection,
+                             (('remove', _id) for _id in ids),
+                             batch_size)
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
@@ -173,6 +499,8 @@ class NoSQLDatabase(Singleton):
         collection = self._table(db_name, collection_name)
         try:
             collection.remove({'_id': _id})
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
@@ -194,37 +522,150 @@ class NoSQLDatabase(Singleton):
         collection = self._table(db_name, collection_name)
         try:
             return collection.find(*args, **kwargs)
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
-    @retry_connect
+    @auto_connect
     def put_file(self, db_name, collection_name, data, name):
-        """ put data into gridfs """
-        fsdbh = gridfs.GridFS(self._database(db_name),
-                              collection=collection_name)
+        """ put data into gridfs
+
+        data is either a string or a file object, read by chunks
+
+        A new file is created on each call: this call is not retried when
+        the connection is lost, IrmaDatabaseError is raised instead.
+        """
+        fsdbh = self._gridfs(db_name, collection_name)
         # create a new record
         try:
             file_oid = fsdbh.put(data, filename=name)
             return file_oid
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            raise IrmaDatabaseError("{0}".format(e))
+
+    @auto_connect
+    def put_file_dedup(self, db_name, collection_name, data, name):
+        """ put data into gridfs unless the same content is already stored
+
+        Files are identified by the sha256 of their content and hold a
+        reference count. When the content is already stored, its reference
+        count is incremented instead of storing it again. Seekable file
+        objects are hashed before being sent, other ones while streamed.
+        Files must be deleted with delete_file_dedup.
+
+        Reference counting is not idempotent: this call is not retried when
+        the connection is lost, IrmaDatabaseError is raised instead.
+
+        :return: the object-id of the new or existing file
+        """
+        fsdbh = self._gridfs(db_name, collection_name)
+        try:
+            files = self._dedup_files(db_name, collection_name)
+            sha256 = None
+            if not hasattr(data, 'read'):
+                hasher = Hasher(['sha256'])
+                hasher.update(data)
+                sha256 = hasher.hexdigest()
+            else:
+                start = None
+                try:
+                    start = data.tell()
+                    data.seek(start)
+                except (AttributeError, EnvironmentError):
+                    start = None
+                if start is None:
+                    # not seekable, hash while sending
+                    data = _HashingReader(data)
+                else:
+                    hasher = Hasher(['sha256'])
+                    hasher.update_from_fileobj(data)
+                    data.seek(start)
+                    sha256 = hasher.hexdigest()
+            if sha256 is not None:
+                file_oid = self._add_reference(files, sha256)
+                if file_oid is not None:
+                    return file_oid
+            file_oid = fsdbh.put(data, filename=name)
+            if sha256 is None:
+                sha256 = data.hasher.hexdigest()
+            # publish the new file unless the same content has been stored
+            # meanwhile, the unique index ensuring there is only one winner
+            while True:
+                existing_oid = self._add_reference(files, sha256)
+                if existing_oid is not None:
+                    fsdbh.delete(file_oid)
+                    return existing_oid
+                try:
+                    self._update_one(files, {"_id": file_oid},
+                                     {"$set": {"sha256": sha256,
+                                               "refcount": 1}})
+                    return file_oid
+                except DuplicateKeyError:
+                    continue
+        except ConnectionFailure:
+            raise
+        except Exception as e:
+            raise IrmaDatabaseError("{0}".format(e))
+
+    @auto_connect
+    def delete_file_dedup(self, db_name, collection_name, file_oid):
+        """ drop a reference to a file stored with put_file_dedup
+
+        The file is deleted from gridfs with its last reference. Files
+        without reference count are deleted right away. As put_file_dedup,
+        this call is not retried when the connection is lost.
+        """
+        fsdbh = self._gridfs(db_name, collection_name)
+        try:
+            files = self._dedup_files(db_name, collection_name)
+            while True:
+                if self._update_one(files,
+                                    {"_id": file_oid,
+                                     "refcount": {"$gt": 1}},
+                                    {"$inc": {"refcount": -1}}):
+                    return
+                # last reference: unpublish the file before deleting it
+                # so that it can not be referenced again meanwhile
+                if self._update_one(files,
+                                    {"_id": file_oid,
+                                     "refcount": {"$lte": 1}},
+                                    {"$unset": {"sha256": "",
+                                                "refcount": ""}}):
+                    break
+                if files.find_one({"_id": file_oid,
+                                   "refcount": {"$exists": True}}) is None:
+                    break
+                # referenced again meanwhile, retry
+            return fsdbh.delete(file_oid)
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
     @retry_connect
     def get_file(self, db_name, collection_name, file_oid):
         """ get data from gridfs by file object-id """
-        fsdbh = gridfs.GridFS(self._database(db_name),
-                              collection=collection_name)
+        # reuse the cached bucket when pymongo provides them
+        bucket = self._gridfs_bucket(db_name, collection_name)
         try:
-            return fsdbh.get(file_oid)
+            if bucket is not None:
+                return bucket.open_download_stream(file_oid)
+            return self._gridfs(db_name, collection_name).get(file_oid)
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
 
     @retry_connect
     def delete_file(self, db_name, collection_name, file_oid):
         """ delete from gridfs by file object-id """
-        fsdbh = gridfs.GridFS(self._database(db_name),
-                              collection=collection_name)
+        fsdbh = self._gridfs(db_name, collection_name)
         try:
             return fsdbh.delete(file_oid)
+        except ConnectionFailure:
+            raise
         except Exception as e:
             raise IrmaDatabaseError("{0}".format(e))
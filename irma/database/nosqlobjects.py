@@ -13,6 +13,11 @@
 # modified, propagated, or distributed except according to the
 # terms contained in the LICENSE file.
 
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from nosqlhandler import NoSQLDatabase
 from bson import ObjectId
 from bson.errors import InvalidId
@@ -33,6 +38,9 @@ class NoSQLDatabaseObject(object):
     _dbname = None
     _collection = None
 
+    # Updates buffered by the unit of work of the thread, if any
+    _pending = threading.local()
+
     # List of transient attributes of the class (see to_dict)
     _transient_attributes = [
         '_transient_attributes',
@@ -108,9 +116,50 @@ class NoSQLDatabaseObject(object):
             if update_dict == {}:
                 update_dict = self.to_dict()
                 del update_dict['_id']
+            if self._buffer_update(update_dict):
+                return
             db.update(self._dbname, self._collection, self._id, update_dict)
         return
 
+    def _buffer_update(self, update_dict):
+        """Buffer update in the current unit of work, if any
+        :rtype: bool
+        :return: True if the update has been buffered
+        """
+        updates = getattr(NoSQLDatabaseObject._pending, 'updates', None)
+        if updates is None:
+            return False
+        key = (self._uri, self._dbname, self._collection)
+        objects = updates.setdefault(key, OrderedDict())
+        objects.setdefault(self._id, {}).update(update_dict)
+        return True
+
+    @classmethod
+    @contextmanager
+    def unit_of_work(cls, batch_size=1000):
+        """Context buffering the updates of objects made in the current
+        thread and flushing them with bulk updates on exit.
+        Successive updates of a same object are merged. Buffered updates
+        are dropped if the block raises. Nested units of work are part of
+        the outermost one.
+        :param batch_size: maximum number of updates per bulk write
+        :raise: IrmaDatabaseError
+        """
+        pending = NoSQLDatabaseObject._pending
+        if getattr(pending, 'updates', None) is not None:
+            yield
+            return
+        pending.updates = OrderedDict()
+        try:
+            yield
+            updates = pending.updates
+        finally:
+            pending.updates = None
+        for (uri, dbname, collection), objects in updates.items():
+            db = NoSQLDatabase(dbname, uri)
+            db.bulk_update(dbname, collection, list(objects.items()),
+                           batch_size=batch_size)
+
     def _save(self):
         db = NoSQLDatabase(self._dbname, self._uri)
         self._id = db.save(self._dbname, self._collection, self.to_dict())
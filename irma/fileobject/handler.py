@@ -22,6 +22,9 @@ class FileObject(object):
     _uri = None
     _dbname = None
     _collection = None
+    # store identical contents once, identified by their sha256, and
+    # count references to them (see NoSQLDatabase.put_file_dedup)
+    _dedup = False
 
     def __init__(self, dbname=None, id=None):
         if dbname:
@@ -37,21 +40,90 @@ class FileObject(object):
         self._dbfile = db.get_file(self._dbname, self._collection, self._id)
 
     def save(self, data, name):
+        """Store data in gridfs
+        :param data: the content, either a string or a file object which
+            is then read by chunks, without loading it in memory
+        :param name: the filename
+        """
         db = NoSQLDatabase(self._dbname, self._uri)
-        self._id = db.put_file(self._dbname, self._collection, data, name)
+        if self._dedup:
+            # name of the first submission is kept for shared contents
+            self._id = db.put_file_dedup(self._dbname, self._collection,
+                                         data, name)
+        else:
+            self._id = db.put_file(self._dbname, self._collection, data,
+                                   name)
         # refresh _dbfile field
         self.load()
 
     def delete(self):
         db = NoSQLDatabase(self._dbname, self._uri)
-        db.delete_file(self._dbname, self._collection, self._id)
+        if self._dedup:
+            db.delete_file_dedup(self._dbname, self._collection, self._id)
+        else:
+            db.delete_file(self._dbname, self._collection, self._id)
+
+    def _file(self):
+        if self._dbfile is None:
+            raise IrmaDatabaseError("File has no data")
+        return self._dbfile
 
     @property
     def data(self):
         """Get the data"""
-        if self._dbfile is None:
-            raise IrmaDatabaseError("File has no data")
-        return self._dbfile.read()
+        dbfile = self._file()
+        dbfile.seek(0)
+        return dbfile.read()
+
+    @property
+    def size(self):
+        """Return the size of the data"""
+        return self._file().length
+
+    def chunks(self, chunk_size=None, start=0, end=None):
+        """Iterate over the data by chunks, in constant memory
+        :param chunk_size: size of the chunks, gridfs one by default
+        :param start: offset of the first byte
+        :param end: offset following the last byte, end of data by default
+        :rtype: generator of strings
+        """
+        dbfile = self._file()
+        if chunk_size is None:
+            chunk_size = dbfile.chunk_size
+        if end is None or end > dbfile.length:
+            end = dbfile.length
+        dbfile.seek(start)
+        position = start
+        while position < end:
+            chunk = dbfile.read(min(chunk_size, end - position))
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+
+    def read_range(self, start, size=-1):
+        """Read size bytes of data from offset start
+        :param start: offset of the first byte
+        :param size: number of bytes, until the end of data if negative
+        :rtype: string
+        """
+        dbfile = self._file()
+        dbfile.seek(start)
+        return dbfile.read(size)
+
+    def readinto(self, buf, start=None):
+        """Read data into a writable buffer such as a bytearray
+        :param buf: the buffer, filled up to its length
+        :param start: offset of the first byte, current position if None
+        :rtype: int
+        :return: the number of bytes read, 0 at the end of data
+        """
+        dbfile = self._file()
+        if start is not None:
+            dbfile.seek(start)
+        data = dbfile.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
 
     @property
     def id(self):
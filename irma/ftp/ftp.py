@@ -13,7 +13,7 @@
 # modified, propagated, or distributed except according to the
 # terms contained in the LICENSE file.
 
-from common.hash import sha256sum
+from common.hash import sha256sum, Hasher
 from irma.common.exceptions import IrmaFtpError
 import os
 
@@ -69,8 +69,18 @@ class IrmaFTP(object):
         # and checked at retrieval
         return sha256sum(fobj)
 
-    def _check_hash(self, digest, fobj):
-        if self._hash(fobj) != digest:
+    def _hasher(self):
+        # incremental version of _hash, to be fed during transfers
+        return Hasher(['sha256'])
+
+    def _check_hash(self, digest, fobj, hasher=None):
+        # if data was hashed during the transfer, do not read fobj again
+        if hasher is not None:
+            fobj.seek(0)
+            computed = hasher.hexdigest()
+        else:
+            computed = self._hash(fobj)
+        if computed != digest:
             raise IrmaFtpError("Integrity check file failed")
 
     def _tweaked_join(self, path1, path2):
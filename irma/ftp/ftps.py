@@ -125,9 +125,14 @@ class IrmaFTPS(IrmaFTP):
         try:
             dstpath = self._get_realpath(path)
             dstpath = self._tweaked_join(path, remotename)
-            self._conn.retrbinary("RETR {0}".format(dstpath),
-                                  lambda x: fobj.write(x))
-            self._check_hash(remotename, fobj)
+            hasher = self._hasher()
+
+            def write(data):
+                fobj.write(data)
+                hasher.update(data)
+
+            self._conn.retrbinary("RETR {0}".format(dstpath), write)
+            self._check_hash(remotename, fobj, hasher)
         except Exception as e:
             raise IrmaFTPSError("{0}".format(e))
 
@@ -24,6 +24,18 @@ log = logging.getLogger(__name__)
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
 
+class _HashingWriter(object):
+    """File object wrapper feeding a hasher with the data written"""
+
+    def __init__(self, fobj, hasher):
+        self.fobj = fobj
+        self.hasher = hasher
+
+    def write(self, data):
+        self.fobj.write(data)
+        self.hasher.update(data)
+
+
 class IrmaSFTP(IrmaFTP):
     """Irma SFTP handler
 
@@ -95,9 +107,10 @@ class IrmaSFTP(IrmaFTP):
         try:
             dstpath = self._get_realpath(path)
             full_dstpath = self._tweaked_join(dstpath, remotename)
-            self._client.getfo(full_dstpath, fobj)
+            hasher = self._hasher()
+            self._client.getfo(full_dstpath, _HashingWriter(fobj, hasher))
             # remotename is hashvalue of data
-            self._check_hash(remotename, fobj)
+            self._check_hash(remotename, fobj, hasher)
         except Exception as e:
             raise IrmaSFTPError("{0}".format(e))
 
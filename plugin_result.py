@@ -14,7 +14,20 @@
 # terms contained in the LICENSE file.
 
 import sys
-import pprint
+import json
+import random
+
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_unpack_options = {'raw': False}
+# msgpack >= 1.0 only accepts str and bytes map keys by default
+if msgpack is not None and msgpack.version >= (0, 6, 1):
+    _unpack_options['strict_map_key'] = False
 
 
 # TODO: Replace PluginResult by a class that perform type checking
@@ -36,9 +49,20 @@ class PluginResult(dict):
         [ ... followed by plugin specific data ... ]
     }
 
+    Values are reachable both as items and as attributes (None for unknown
+    ones). In memory, a result is a plain dict: the compact representation,
+    minimal format fields stored positionally followed by a mapping of
+    plugin specific data, is only used by ``to_bytes``.
     """
 
+    fields = ('name', 'type', 'version', 'platform',
+              'duration', 'status', 'error', 'results')
+    __slots__ = ()
+
     def __getattr__(self, key):
+        # special lookups (pickle protocol...) must not be answered by None
+        if key.startswith('__'):
+            raise AttributeError(key)
         return self.get(key, None)
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
@@ -59,3 +83,204 @@ class PluginResult(dict):
         # get remaining values form kwargs
         for key, value in kwargs.items():
             setattr(self, key, value)
+
+    def __reduce__(self):
+        return (self.__class__, (), None, None, iter(self.items()))
+
+    def copy(self):
+        return self.__class__(**self)
+
+    def to_dict(self):
+        """Return a plain dict"""
+        return dict(self)
+
+    # ===============
+    #  serialization
+    # ===============
+
+    def to_bytes(self):
+        """Serialize result in a compact form
+
+        Minimal format fields are stored positionally, followed by plugin
+        specific data. msgpack is used when available, json otherwise.
+        """
+        values = [self.get(key) for key in self.fields]
+        values.append(dict((key, value) for (key, value) in self.items()
+                           if key not in self.fields))
+        if msgpack is not None:
+            return b'M' + msgpack.packb(values, use_bin_type=True)
+        return b'J' + json.dumps(values, separators=(',', ':')).encode('utf8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Build a result from the output of ``to_bytes``"""
+        encoding, payload = data[:1], data[1:]
+        if encoding == b'M':
+            if msgpack is None:
+                raise ValueError("msgpack is required to decode this result")
+            values = msgpack.unpackb(payload, **_unpack_options)
+        elif encoding == b'J':
+            values = json.loads(payload.decode('utf8'))
+        else:
+            raise ValueError("unknown result encoding")
+        kwargs = dict(zip(cls.fields, values))
+        kwargs.update(values[-1])
+        return cls(**kwargs)
+
+
+class _ProbeStats(object):
+    """Bounded memory statistics of the results of one probe"""
+
+    __slots__ = ('count', 'statuses', 'errors', 'total', 'minimum',
+                 'maximum', 'samples', 'timed')
+
+    def __init__(self):
+        self.count = 0
+        self.statuses = {}
+        self.errors = 0
+        self.timed = 0
+        self.total = 0.
+        self.minimum = None
+        self.maximum = None
+        self.samples = []
+
+
+class PluginResultAggregator(object):
+    """Aggregate PluginResult as they are produced
+
+    Keeps, per probe, a status histogram, an error count and duration
+    statistics (percentiles are estimated on a fixed size reservoir sample)
+    and, per file, a verdict summary. Memory does not depend on the number
+    of results: once ``max_files`` files are summarized, the oldest summary
+    is evicted, and handed to ``on_evict`` if given.
+    """
+
+    def __init__(self, reservoir_size=1024, max_files=10000, on_evict=None):
+        """
+        :param reservoir_size: number of durations sampled per probe
+        :param max_files: number of file summaries kept
+        :param on_evict: callable receiving (filename, summary) of evicted
+            file summaries
+        """
+        self.reservoir_size = reservoir_size
+        self.max_files = max_files
+        self.on_evict = on_evict
+        self.evicted = 0
+        self._probes = {}
+        self._files = OrderedDict()
+        self._random = random.Random()
+
+    def add(self, result, filename=None):
+        """Account for a result
+
+        :param result: PluginResult (or dict with the same keys)
+        :param filename: file the result is about, if it has to be
+            summarized per file
+        """
+        name = result.get('name')
+        status = result.get('status')
+        error = result.get('error')
+        duration = result.get('duration')
+        failed = error is not None or (status is not None and status < 0)
+
+        stats = self._probes.get(name)
+        if stats is None:
+            stats = self._probes[name] = _ProbeStats()
+        stats.count += 1
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        if failed:
+            stats.errors += 1
+        if duration is not None:
+            stats.timed += 1
+            stats.total += duration
+            if stats.minimum is None or duration < stats.minimum:
+                stats.minimum = duration
+            if stats.maximum is None or duration > stats.maximum:
+                stats.maximum = duration
+            # reservoir sampling (algorithm R)
+            if len(stats.samples) < self.reservoir_size:
+                stats.samples.append(duration)
+            else:
+                index = self._random.randint(0, stats.timed - 1)
+                if index < self.reservoir_size:
+                    stats.samples[index] = duration
+
+        if filename is not None:
+            summary = self._files.get(filename)
+            if summary is None:
+                summary = self._files[filename] = {'probes': 0,
+                                                   'errors': 0,
+                                                   'detections': 0}
+                while len(self._files) > self.max_files:
+                    evicted = self._files.popitem(last=False)
+                    self.evicted += 1
+                    if self.on_evict is not None:
+                        self.on_evict(*evicted)
+            summary['probes'] += 1
+            if failed:
+                summary['errors'] += 1
+            elif status is not None and status > 0:
+                summary['detections'] += 1
+
+    def extend(self, results):
+        """Account for an iterable of results or of (filename, result)
+
+        ``PluginExecutor.map`` output can be given directly.
+        """
+        for item in results:
+            if isinstance(item, tuple):
+                self.add(item[1], item[0])
+            else:
+                self.add(item)
+
+    @staticmethod
+    def _percentile(samples, percent):
+        index = int(round(percent / 100. * (len(samples) - 1)))
+        return samples[index]
+
+    def probe_stats(self, name):
+        """Return statistics of a probe
+
+        :param name: name of the probe
+        :return: dict with count, status histogram, errors and durations
+        """
+        stats = self._probes[name]
+        durations = None
+        if stats.timed:
+            samples = sorted(stats.samples)
+            durations = {'min': stats.minimum,
+                         'max': stats.maximum,
+                         'mean': stats.total / stats.timed,
+                         'p50': self._percentile(samples, 50),
+                         'p90': self._percentile(samples, 90),
+                         'p99': self._percentile(samples, 99)}
+        return {'count': stats.count,
+                'status': dict(stats.statuses),
+                'errors': stats.errors,
+                'duration': durations}
+
+    def probes(self):
+        """Return names of the aggregated probes"""
+        return list(self._probes.keys())
+
+    def file_summary(self, filename):
+        """Return verdict summary of a file
+
+        verdict is 'detected' if at least one probe detected something,
+        'error' if all probes failed and 'clean' otherwise.
+
+        :param filename: file name given to ``add``
+        :return: dict with probes, errors, detections counts and verdict
+        """
+        summary = dict(self._files[filename])
+        if summary['detections']:
+            summary['verdict'] = 'detected'
+        elif summary['errors'] == summary['probes']:
+            summary['verdict'] = 'error'
+        else:
+            summary['verdict'] = 'clean'
+        return summary
+
+    def files(self):
+        """Return names of the summarized files, oldest first"""
+        return list(self._files.keys())
@@ -1,6 +1,12 @@
 from .plugin import PluginBase
+from .plugin import PluginMetrics
+from .plugin import timed
 
 from .manager import PluginManager
+from .manifest import PluginManifest
+from .executor import PluginExecutor
+from .pool import PluginInstancePool
+from .isolation import IsolatedPluginRunner
 
 from .exceptions import PluginError
 from .exceptions import PluginLoadError
@@ -13,6 +19,7 @@ from .exceptions import FileDependencyMissing
 from .exceptions import FolderDependencyMissing
 from .exceptions import PlatformDependencyMissing
 
+from .dependencies import DependencyCache
 from .dependencies import Dependency
 from .dependencies import ModuleDependency
 from .dependencies import BinaryDependency
@@ -23,8 +30,18 @@ from .dependencies import PlatformDependency
 __all__ = [
     # from plugin.py
     'PluginBase',
+    'PluginMetrics',
+    'timed',
     # from manager.py
     'PluginManager',
+    # from manifest.py
+    'PluginManifest',
+    # from executor.py
+    'PluginExecutor',
+    # from pool.py
+    'PluginInstancePool',
+    # from isolation.py
+    'IsolatedPluginRunner',
     # from exception.py
     'PluginError',
     'PluginLoadError',
@@ -37,6 +54,7 @@ __all__ = [
     'FolderDependencyMissing',
     'PlatformDependencyMissing',
     # from dependency.py
+    'DependencyCache',
     'Dependency',
     'ModuleDependency',
     'BinaryDependency',
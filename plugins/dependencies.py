@@ -15,28 +15,71 @@
 
 import os
 import sys
+import time
+import threading
 
 from importlib import import_module
 
-try:  # from python3, shutil has a which like command
-    from shutil import which
-except ImportError:
-    from .which import which
+from .which import indexed_which
 
 
 ##############################################################################
 # Plugin imports
 ##############################################################################
 
-from exceptions import PluginError, PluginCrashed
-from exceptions import PluginLoadError, PluginFormatError
+from .exceptions import PluginError, PluginCrashed
+from .exceptions import PluginLoadError, PluginFormatError
 
-from exceptions import DependencyMissing
-from exceptions import ModuleDependencyMissing
-from exceptions import BinaryDependencyMissing
-from exceptions import FileDependencyMissing
-from exceptions import FolderDependencyMissing
-from exceptions import PlatformDependencyMissing
+from .exceptions import DependencyMissing
+from .exceptions import ModuleDependencyMissing
+from .exceptions import BinaryDependencyMissing
+from .exceptions import FileDependencyMissing
+from .exceptions import FolderDependencyMissing
+from .exceptions import PlatformDependencyMissing
+
+
+##############################################################################
+# Dependency cache
+##############################################################################
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class DependencyCache(object):
+    """Process-wide cache of dependency checks results
+
+    Results, positive as well as negative, are indexed by dependency key
+    (type and name) and kept for ``ttl`` seconds, forever if ttl is None.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached result for key, None if unknown or expired"""
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            satisfied, checked = entry
+            if self.ttl is not None and _clock() - checked > self.ttl:
+                del self._results[key]
+                return None
+            return satisfied
+
+    def set(self, key, satisfied):
+        with self._lock:
+            self._results[key] = (satisfied, _clock())
+
+    def invalidate(self, key=None):
+        """Forget result of key, or every result if key is None"""
+        with self._lock:
+            if key is None:
+                self._results.clear()
+            else:
+                self._results.pop(key, None)
 
 
 ##############################################################################
@@ -46,21 +89,34 @@ from exceptions import PlatformDependencyMissing
 class Dependency(object):
 
     exception = DependencyMissing
+    # shared by all dependency types, see DependencyCache
+    cache = DependencyCache()
 
     def __init__(self, dependency_name, help=None):
         self.dependency_name = dependency_name
         self.help = help
-        self._was_satisfied = None
+
+    @property
+    def key(self):
+        # identifies equivalent dependencies declared by several plugins
+        name = self.dependency_name
+        if isinstance(name, list):
+            name = tuple(name)
+        return (self.__class__.__name__, name)
 
     def is_satisfied(self):
         raise NotImplementedError
 
     def satisfied(self):
-        # _was_satisfied is the cached value for is_satisfied()
-        satisfied = getattr(self, '_was_satisfied')
-        if not satisfied:
-            self._was_satisfied = self.is_satisfied()
-        return self._was_satisfied
+        # results are shared with all equivalent dependencies
+        satisfied = self.cache.get(self.key)
+        if satisfied is None:
+            satisfied = bool(self.is_satisfied())
+            self.cache.set(self.key, satisfied)
+        return satisfied
+
+    def invalidate(self):
+        self.cache.invalidate(self.key)
 
     def check(self):
         if not self.satisfied():
@@ -87,10 +143,10 @@ class BinaryDependency(Dependency):
 
     def is_satisfied(self):
         if isinstance(self.dependency_name, list):
-            dependency_found = map(lambda x: which(x), self.dependency_name)
-            return reduce(lambda x, y: x or y, dependency_found, False)
+            return any(indexed_which(name) is not None
+                       for name in self.dependency_name)
         else:
-            return which(self.dependency_name) is not None
+            return indexed_which(self.dependency_name) is not None
 
     def __str__(self):
         return self.dependency_name
@@ -0,0 +1,489 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from ..plugin_result import PluginResult
+from .plugin import Measure
+
+
+##############################################################################
+# Plugin execution
+##############################################################################
+
+def _as_result(plugin, output):
+    """Turn what a plugin returned into a PluginResult"""
+    result = PluginResult(name=plugin.plugin_name,
+                          type=plugin.plugin_category,
+                          version=plugin.plugin_version)
+    if isinstance(output, PluginResult):
+        for key in ('name', 'type', 'version'):
+            if output[key] is None:
+                output[key] = result[key]
+        return output
+    result.status = 0
+    result.results = output
+    return result
+
+
+class _Started(object):
+    """Records when a call starts being executed by a worker
+
+    Backed by manager objects when given a multiprocessing manager, so
+    that it can be sent to process pools.
+    """
+
+    def __init__(self, manager=None):
+        if manager is None:
+            self._event = threading.Event()
+            self._at = [None]
+        else:
+            self._event = manager.Event()
+            self._at = manager.list([None])
+
+    def set(self):
+        self._at[0] = time.time()
+        self._event.set()
+
+    def wait(self, timeout=None):
+        # python 2 Event.wait returns None on timeout
+        self._event.wait(timeout)
+        return self._event.is_set()
+
+    @property
+    def at(self):
+        return self._at[0]
+
+
+def _run_plugin(plugin, method, filename, instance_pool=None, started=None):
+    """Run a plugin on a file and describe the outcome as a PluginResult
+
+    Defined at module level so that it can be sent to process pools. It
+    never raises: errors raised by the plugin are reported in the result.
+    """
+    if started is not None:
+        started.set()
+    measure = Measure()
+    try:
+        with measure:
+            if instance_pool is None:
+                output = getattr(plugin(), method)(filename)
+            else:
+                with instance_pool.instance(plugin) as instance:
+                    output = getattr(instance, method)(filename)
+        result = _as_result(plugin, output)
+    except Exception as error:
+        result = _as_result(plugin, None)
+        result.status = -1
+        result.error = '{0}'.format(error)
+    # keep the measure of plugins instrumented with @timed
+    if result.duration is None:
+        result.duration = measure.duration
+    return result
+
+
+def _run_plugin_batch(plugin, filenames, instance_pool=None, started=None):
+    """Run a plugin on a batch of files with its ``run_batch`` method
+
+    Falls back to one ``run`` call per file if the batch fails, so that a
+    single bad file does not fail the others. Returns a list of
+    PluginResult, duration of the batch being shared between them.
+    """
+    if started is not None:
+        started.set()
+    measure = Measure()
+    try:
+        with measure:
+            if instance_pool is None:
+                outputs = list(plugin().run_batch(filenames))
+            else:
+                with instance_pool.instance(plugin) as instance:
+                    outputs = list(instance.run_batch(filenames))
+        if len(outputs) != len(filenames):
+            raise ValueError("{0} results for {1} files"
+                             "".format(len(outputs), len(filenames)))
+    except Exception as error:
+        logging.warn(' *** [{name}] Batch failed, running files one by '
+                     'one: {error}'.format(name=plugin.plugin_name,
+                                           error=error))
+        return [_run_plugin(plugin, 'run', filename, instance_pool)
+                for filename in filenames]
+    results = [_as_result(plugin, output) for output in outputs]
+    for result in results:
+        if result.duration is None:
+            result.duration = round(measure.duration / len(results), 2)
+    return results
+
+
+class PluginCall(object):
+    """Pending execution of a plugin on a file"""
+
+    def __init__(self, plugin, filename, timeout=None, started=None):
+        self.plugin = plugin
+        self.filename = filename
+        self.timeout = timeout
+        self.started = started
+        self._async = None
+
+    def ready(self):
+        return self._async.ready()
+
+    def get(self):
+        """Wait for the PluginResult of the call
+
+        The call timeout is counted from the moment a worker starts
+        executing it: time spent waiting for a worker or for a concurrency
+        slot does not count. On expiration, an error result is returned,
+        the plugin being left running, except for isolated plugins whose
+        worker process is killed.
+        """
+        if self.timeout is None or self.started is None:
+            return self._async.get()
+        while not self.started.wait(0.1):
+            # the call may have failed before being executed
+            if self._async.ready():
+                return self._async.get()
+        timeout = max(0, self.started.at + self.timeout - time.time())
+        try:
+            return self._async.get(timeout)
+        except multiprocessing.TimeoutError:
+            return PluginResult(name=self.plugin.plugin_name,
+                                type=self.plugin.plugin_category,
+                                version=self.plugin.plugin_version,
+                                duration=round(self.timeout * 1000, 2),
+                                status=-1,
+                                error='timeout after {0}s'
+                                      ''.format(self.timeout))
+
+
+class PluginBatchCall(PluginCall):
+    """Pending execution of a plugin on a batch of files
+
+    ``get`` returns the list of PluginResult, in the order of the files.
+    """
+
+    def __init__(self, plugin, filenames, timeout=None, started=None):
+        # timeout applies to each file of the batch
+        if timeout is not None:
+            timeout *= len(filenames)
+        super(PluginBatchCall, self).__init__(plugin, None, timeout,
+                                              started)
+        self.filenames = filenames
+
+    def get(self):
+        results = super(PluginBatchCall, self).get()
+        if isinstance(results, PluginResult):
+            # timeout
+            return [results.copy() for _ in self.filenames]
+        return results
+
+
+class _BatchItem(object):
+    """Result of one of the files of a PluginBatchCall"""
+
+    def __init__(self, call, index):
+        self.call = call
+        self.filename = call.filenames[index]
+        self.index = index
+
+    def get(self):
+        return self.call.get()[self.index]
+
+
+class PluginExecutor(object):
+    """Run plugins over files in a pool of threads or processes
+
+    Plugins are instantiated for each file, or taken from an instance pool,
+    and their ``method`` (``run`` by default) called with the filename.
+    Whatever the plugin returns, the call produces a PluginResult with
+    ``duration``, ``status`` and ``error`` filled. In ``map``, files are
+    grouped for plugins implementing ``run_batch`` (see
+    ``plugin_batch_size``), a batch being sent when full or, by a timer,
+    when its first file waited ``batch_latency`` seconds.
+
+        .. code-block:: python
+
+            with PluginExecutor(workers=8, timeout=60,
+                                max_concurrency={'ClamAV': 2},
+                                isolate=['ClamAV']) as executor:
+                for filename, result in executor.map(plugins, filenames):
+                    print(filename, result.status)
+
+    """
+
+    modes = ('thread', 'process')
+
+    def __init__(self, workers=4, mode='thread', timeout=None,
+                 max_concurrency=None, method='run', instance_pool=None,
+                 isolate=None, isolation_workers=1, batch_latency=0.1):
+        """
+        :param workers: size of the pool
+        :param mode: 'thread' or 'process'. In process mode, plugins must
+            be importable by the workers and their results picklable
+        :param timeout: default timeout of a call, in seconds
+        :param max_concurrency: maximum number of concurrent calls of a same
+            plugin, either an int for all plugins or a dict indexed by
+            plugin name (plugins not listed are not limited). A call keeps
+            its slot until the plugin returns, even after its timeout
+            expired: plugins that may hang forever should be isolated
+        :param method: name of the plugin method to run
+        :param instance_pool: optional PluginInstancePool providing warm
+            plugin instances instead of creating one per file (thread mode
+            only)
+        :param isolate: names of the plugins to run in dedicated worker
+            processes, see IsolatedPluginRunner (thread mode only)
+        :param isolation_workers: number of worker processes of each
+            isolated plugin
+        :param batch_latency: maximum time in seconds a file waits for its
+            batch to be full in ``map``
+        """
+        if mode not in self.modes:
+            raise ValueError("mode must be one of {0}".format(self.modes))
+        if instance_pool is not None and mode != 'thread':
+            raise ValueError("instance pools are only usable in thread mode")
+        if isolate and mode != 'thread':
+            raise ValueError("isolation is only usable in thread mode")
+        self.workers = workers
+        self.mode = mode
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.method = method
+        self.instance_pool = instance_pool
+        self.isolate = set(isolate or ())
+        self.isolation_workers = isolation_workers
+        self.batch_latency = batch_latency
+        self._manager = None
+        if mode == 'thread':
+            self._pool = ThreadPool(workers)
+        else:
+            self._pool = multiprocessing.Pool(workers)
+            if timeout is not None:
+                # shares start time of the calls with the workers
+                self._manager = multiprocessing.Manager()
+        self._limits = {}
+        self._runners = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    ##########################################################################
+    # internals
+    ##########################################################################
+
+    def _semaphore(self, plugin):
+        """Return the semaphore limiting concurrent calls of plugin"""
+        limit = self.max_concurrency
+        if isinstance(limit, dict):
+            limit = limit.get(plugin.plugin_name)
+        if limit is None:
+            return None
+        with self._lock:
+            if plugin not in self._limits:
+                self._limits[plugin] = threading.BoundedSemaphore(limit)
+            return self._limits[plugin]
+
+    def _runner(self, plugin):
+        """Return the isolated runner of plugin, None if not isolated"""
+        if plugin.plugin_name not in self.isolate:
+            return None
+        # imported here as isolation relies on this module
+        from .isolation import IsolatedPluginRunner
+        with self._lock:
+            if plugin not in self._runners:
+                self._runners[plugin] = IsolatedPluginRunner(
+                    plugin,
+                    workers=self.isolation_workers,
+                    method=self.method)
+            return self._runners[plugin]
+
+    def _batch_size(self, plugin):
+        """Return the batch size used for plugin, None if not batched"""
+        if self.method != 'run' or plugin.plugin_name in self.isolate:
+            return None
+        size = plugin.plugin_batch_size
+        if size is None or size < 2:
+            return None
+        return size
+
+    def _apply(self, plugin, call, func, args):
+        """Send func(*args) to the pool once plugin concurrency allows"""
+        semaphore = self._semaphore(plugin)
+        if semaphore is not None:
+            semaphore.acquire()
+
+        def release(_):
+            if semaphore is not None:
+                semaphore.release()
+
+        kwargs = {'callback': release}
+        if sys.version_info >= (3,):
+            kwargs['error_callback'] = release
+        call._async = self._pool.apply_async(func, args, **kwargs)
+        return call
+
+    def _started(self, timeout):
+        """Return a start marker for a call, None if it has no timeout"""
+        if timeout is None:
+            return None
+        if self.mode == 'process' and self._manager is None:
+            with self._lock:
+                if self._manager is None:
+                    self._manager = multiprocessing.Manager()
+        return _Started(self._manager)
+
+    def _shutdown(self):
+        with self._lock:
+            runners, self._runners = list(self._runners.values()), {}
+            manager, self._manager = self._manager, None
+        for runner in runners:
+            runner.close()
+        if manager is not None:
+            manager.shutdown()
+
+    ##########################################################################
+    # public methods
+    ##########################################################################
+
+    def submit(self, plugin, filename, timeout=None):
+        """Schedule the execution of plugin on filename
+
+        Blocks while the plugin already runs its maximum number of
+        concurrent calls. As calls that timed out keep their slot until the
+        plugin returns, this blocks forever if that many calls hang.
+
+        :param plugin: plugin class
+        :param filename: file to process
+        :param timeout: timeout of the call, defaults to executor one
+        :return: PluginCall
+        """
+        if timeout is None:
+            timeout = self.timeout
+        started = self._started(timeout)
+        call = PluginCall(plugin, filename, timeout, started)
+        runner = self._runner(plugin)
+        if runner is not None:
+            # the worker is killed and respawned when the call times out
+            func, args = runner.run, (filename, timeout, started)
+        else:
+            func = _run_plugin
+            args = (plugin, self.method, filename, self.instance_pool,
+                    started)
+        return self._apply(plugin, call, func, args)
+
+    def submit_batch(self, plugin, filenames, timeout=None):
+        """Schedule the execution of plugin on a batch of files
+
+        Uses the ``run_batch`` method of the plugin, which counts as a
+        single call regarding concurrency limits.
+
+        :param plugin: plugin class implementing ``run_batch``
+        :param filenames: list of files to process
+        :param timeout: timeout per file, defaults to executor one
+        :return: PluginBatchCall
+        """
+        if timeout is None:
+            timeout = self.timeout
+        filenames = list(filenames)
+        started = self._started(timeout)
+        call = PluginBatchCall(plugin, filenames, timeout, started)
+        args = (plugin, filenames, self.instance_pool, started)
+        return self._apply(plugin, call, _run_plugin_batch, args)
+
+    def map(self, plugins, filenames):
+        """Run every plugin on every file
+
+        At most twice the pool size calls are pending at a time, so files
+        can be an arbitrary long stream.
+
+        :param plugins: list of plugin classes
+        :param filenames: iterable of files
+        :return: generator of (filename, PluginResult) in submission order
+        """
+        pending = deque()
+        window = 2 * self.workers
+        # plugin -> (latency timer, files waiting for a batch)
+        batches = {}
+        # batches are flushed by the generator and by latency timers
+        lock = threading.Lock()
+
+        def flush(plugin, batch=None):
+            with lock:
+                timer, files = batches.get(plugin, (None, None))
+                # the timer of a batch already sent
+                if files is None or batch not in (None, files):
+                    return
+                del batches[plugin]
+                timer.cancel()
+                call = self.submit_batch(plugin, files)
+                pending.extend(_BatchItem(call, index)
+                               for index in range(len(files)))
+
+        def add(plugin, filename, size):
+            with lock:
+                if plugin not in batches:
+                    files = []
+                    timer = threading.Timer(self.batch_latency, flush,
+                                            (plugin, files))
+                    timer.daemon = True
+                    batches[plugin] = (timer, files)
+                    timer.start()
+                files = batches[plugin][1]
+                files.append(filename)
+            if len(files) >= size:
+                flush(plugin, files)
+
+        try:
+            for filename in filenames:
+                for plugin in plugins:
+                    size = self._batch_size(plugin)
+                    if size is None:
+                        pending.append(self.submit(plugin, filename))
+                    else:
+                        add(plugin, filename, size)
+                while len(pending) > window:
+                    call = pending.popleft()
+                    yield call.filename, call.get()
+            for plugin in list(batches):
+                flush(plugin)
+            while pending:
+                call = pending.popleft()
+                yield call.filename, call.get()
+        finally:
+            with lock:
+                for timer, _ in batches.values():
+                    timer.cancel()
+
+    def close(self):
+        """Wait for pending calls and stop the pool"""
+        self._pool.close()
+        self._pool.join()
+        self._shutdown()
+
+    def terminate(self):
+        """Stop the pool without waiting for pending calls"""
+        logging.debug('Terminating plugin executor')
+        self._pool.terminate()
+        self._shutdown()
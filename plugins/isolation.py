@@ -0,0 +1,207 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import time
+import logging
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from ..plugin_result import PluginResult
+from .exceptions import PluginCrashed
+from .executor import _run_plugin
+from .pool import PluginInstancePool
+
+
+##############################################################################
+# Worker process
+##############################################################################
+
+def _worker_loop(plugin, method, conn):
+    """Serve plugin runs requested over conn until None or EOF is received
+
+    The plugin instance is created once and reused for all the files.
+    Results are sent back encoded with ``PluginResult.to_bytes``.
+    """
+    instance_pool = PluginInstancePool(size=1)
+    try:
+        instance_pool.warm(plugin)
+    except Exception as error:
+        # reported on every call by _run_plugin
+        logging.warn(' *** [{name}] Plugin failed to initialize: {error}'
+                     ''.format(name=plugin.plugin_name, error=error))
+    while True:
+        try:
+            filename = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if filename is None:
+            break
+        result = _run_plugin(plugin, method, filename, instance_pool)
+        try:
+            data = result.to_bytes()
+        except (TypeError, ValueError) as error:
+            data = PluginResult(name=result.name,
+                                type=result.type,
+                                version=result.version,
+                                duration=result.duration,
+                                status=-1,
+                                error='unserializable result ({0})'
+                                      ''.format(error)).to_bytes()
+        conn.send_bytes(data)
+    conn.close()
+
+
+class _IsolatedWorker(object):
+    """Handle on a pre-forked worker process running one plugin"""
+
+    def __init__(self, plugin, method):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker_loop,
+                                               args=(plugin, method,
+                                                     child_conn))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def run(self, filename, timeout=None):
+        """Run plugin on filename in the worker
+
+        :raise: EOFError if the worker died, multiprocessing.TimeoutError
+            if it did not answer in time, ValueError or TypeError if its
+            answer could not be decoded
+        """
+        self.conn.send(filename)
+        if not self.conn.poll(timeout):
+            raise multiprocessing.TimeoutError()
+        return PluginResult.from_bytes(self.conn.recv_bytes())
+
+    def stop(self, kill=False):
+        if not kill:
+            try:
+                self.conn.send(None)
+            except (EnvironmentError, ValueError):
+                kill = True
+        if kill and self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+##############################################################################
+# Isolated plugin runner
+##############################################################################
+
+class IsolatedPluginRunner(object):
+    """Run a plugin in a warm pool of dedicated worker processes
+
+    A crash of the plugin (segfault in an engine, abort...) only kills its
+    worker: the call returns an error result and the worker is respawned.
+    Calls that exceed their timeout also get their worker killed and
+    respawned, which enforces the timeout for real.
+    """
+
+    def __init__(self, plugin, workers=1, method='run', timeout=None):
+        """
+        :param plugin: plugin class
+        :param workers: number of worker processes
+        :param method: name of the plugin method to run
+        :param timeout: default timeout of a call, in seconds
+        """
+        self.plugin = plugin
+        self.method = method
+        self.timeout = timeout
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        for _ in range(workers):
+            self._idle.put(self._spawn())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _spawn(self):
+        worker = _IsolatedWorker(self.plugin, self.method)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _respawn(self, worker):
+        worker.stop(kill=True)
+        with self._lock:
+            self._workers.remove(worker)
+        return self._spawn()
+
+    def _error(self, error, begin):
+        return PluginResult(name=self.plugin.plugin_name,
+                            type=self.plugin.plugin_category,
+                            version=self.plugin.plugin_version,
+                            duration=round((time.time() - begin) * 1000, 2),
+                            status=-1,
+                            error=error)
+
+    def run(self, filename, timeout=None, started=None):
+        """Run the plugin on filename in one of the workers
+
+        Blocks while all workers are busy.
+
+        :param filename: file to process
+        :param timeout: timeout of the call, defaults to runner one
+        :param started: optional object whose ``set`` method is called
+            once a worker is available, when the timeout starts
+        :return: PluginResult
+        """
+        if timeout is None:
+            timeout = self.timeout
+        worker = self._idle.get()
+        if started is not None:
+            started.set()
+        begin = time.time()
+        try:
+            result = worker.run(filename, timeout)
+        except multiprocessing.TimeoutError:
+            worker = self._respawn(worker)
+            result = self._error('timeout after {0}s'.format(timeout),
+                                 begin)
+        except (EOFError, EnvironmentError):
+            worker.process.join(1)
+            reason = 'worker exited with code {0}'.format(
+                worker.process.exitcode)
+            logging.warn(' *** [{name}] Plugin crashed: {reason}'
+                         ''.format(name=self.plugin.plugin_name,
+                                   reason=reason))
+            worker = self._respawn(worker)
+            result = self._error('{0}'.format(PluginCrashed(reason)),
+                                 begin)
+        except (ValueError, TypeError) as error:
+            result = self._error('undecodable result ({0})'.format(error),
+                                 begin)
+        finally:
+            self._idle.put(worker)
+        return result
+
+    def close(self):
+        """Stop all worker processes"""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
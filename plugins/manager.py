@@ -14,10 +14,14 @@
 # terms contained in the LICENSE file.
 
 import os
+import re
 import sys
 import pkgutil
 import logging
 
+from multiprocessing.pool import ThreadPool
+
+from ..common.cache import LRUCache
 from ..common.oopatterns import Singleton
 
 ##############################################################################
@@ -34,10 +38,18 @@ from .dependencies import Dependency
 from .dependencies import ModuleDependency, BinaryDependency
 from .dependencies import FileDependency, FolderDependency, PlatformDependency
 
+from .manifest import PluginManifest
+
 
 class PluginManager(Singleton):
 
     __plugins_cls = {}
+    # plugins waiting for registration while discovery defers it
+    __pending = None
+    # combined matcher of active plugins mimetype regexps, built lazily
+    __mimetype_index = None
+    # memo of selected plugins per distinct mimetype string
+    __mimetype_memo = LRUCache(1024)
 
     ##########################################################################
     # plugin management
@@ -46,43 +58,373 @@ class PluginManager(Singleton):
     def get_all_plugins(self):
         return self.__plugins_cls.values()
 
-    def discover(self, path=os.path.dirname(__file__), prefix=None):
+    def discover(self, path=os.path.dirname(__file__), prefix=None,
+                 manifest=None, plugins=None, workers=None):
+        """Import modules found in path so that their plugins get registered
+
+        :param path: directory to walk
+        :param prefix: package name of path, defaults to its basename
+        :param manifest: optional PluginManifest (or path of its file)
+            recording the content of modules from one run to the next
+        :param plugins: optional list of plugin names. With a manifest,
+            unchanged modules known not to provide any of them, or known to
+            fail loading, are not imported at all. Modules whose plugins
+            missed a dependency are only imported again once it is found
+        :param workers: if set, registration of discovered plugins is
+            deferred until all modules are imported, so that dependencies
+            of all plugins are checked at once by this number of threads
+            (see ``register_plugins``)
+        """
+        if manifest is not None and not isinstance(manifest, PluginManifest):
+            manifest = PluginManifest(manifest)
+        cls = self.__class__
+        loaded = []
+        if workers:
+            cls.__pending = []
+        try:
+            self._discover(path, prefix, manifest, plugins, loaded)
+        finally:
+            pending, cls.__pending = cls.__pending, None
+        failures = {}
+        missing = {}
+        if pending:
+            for plugin, error in self.register_plugins(pending,
+                                                       workers).items():
+                module = plugin.__module__
+                if self._missing_dependency(error) is not None:
+                    missing.setdefault(module, []).append(
+                        self._missing_entry(error))
+                elif self._dependency_failure(error):
+                    failures[module] = None
+                elif failures.get(module, '') is not None:
+                    failures[module] = '{0}'.format(error)
+        if manifest is not None:
+            for pkg_name, filename, failure, module_missing in loaded:
+                if pkg_name in failures and failures[pkg_name] is None:
+                    # dependencies are checked again on next discovery
+                    manifest.remove(pkg_name)
+                    continue
+                registered = [plugin.plugin_name
+                              for plugin in self.__plugins_cls.values()
+                              if plugin.__module__ == pkg_name]
+                manifest.update(pkg_name, filename, registered,
+                                failure or failures.get(pkg_name),
+                                module_missing + missing.get(pkg_name, []))
+            manifest.save()
+
+    @staticmethod
+    def _module_filename(loader, name):
+        try:
+            return loader.get_filename(name)
+        except Exception:
+            return None
+
+    @staticmethod
+    def _dependency_failure(error):
+        """Tell if a load error comes from a missing dependency
+
+        Such errors are not recorded in the manifest as module errors: the
+        dependency may be installed without the module changing.
+        """
+        return getattr(error, 'dependency', None) is not None or \
+            isinstance(error, DependencyMissing)
+
+    @staticmethod
+    def _missing_dependency(error):
+        """Return the missing dependency a load error comes from, if any"""
+        return getattr(error, 'dependency', None)
+
+    @classmethod
+    def _missing_entry(cls, error):
+        """Describe the missing dependency of a load error for the manifest"""
+        dependency = cls._missing_dependency(error)
+        return {'plugin': getattr(error, 'plugin_name', None),
+                'dependency': [dependency.__class__.__name__,
+                               dependency.dependency_name]}
+
+    # dependency types that can be checked again from a manifest entry
+    _dependency_types = dict((dependency.__name__, dependency)
+                             for dependency in (ModuleDependency,
+                                                BinaryDependency,
+                                                FileDependency,
+                                                FolderDependency,
+                                                PlatformDependency))
+
+    @classmethod
+    def _missing_satisfied(cls, missing):
+        """Tell if a dependency recorded as missing is now satisfied"""
+        dependency_type, dependency_name = missing['dependency']
+        dependency = cls._dependency_types.get(dependency_type)
+        if dependency is None:
+            # only the module knows how to check it
+            return True
+        return dependency(dependency_name).satisfied()
+
+    @classmethod
+    def _skip_module(cls, name, entry, plugins):
+        """Tell from a manifest entry if a module can be left unimported"""
+        if entry is None:
+            return False
+        if entry['error'] is not None:
+            logging.warn(' *** [{name}] Plugin failed to load (cached): '
+                         '{error}'.format(name=name, error=entry['error']))
+            return True
+        if plugins is None:
+            if entry['plugins'] or not entry['missing']:
+                return False
+        elif set(entry['plugins']) & set(plugins):
+            return False
+        # other plugins of the module only load once their dependency is
+        # found, which is checked without importing the module
+        for missing in entry['missing']:
+            plugin = missing['plugin']
+            if plugins is not None and plugin is not None and \
+               plugin not in plugins:
+                continue
+            if cls._missing_satisfied(missing):
+                return False
+            logging.warn(' *** [{name}] Plugin failed to load (cached): '
+                         'missing dependency {dependency}'
+                         ''.format(name=plugin or name,
+                                   dependency=missing['dependency'][1]))
+        return True
+
+    def _discover(self, path, prefix, manifest, plugins, loaded):
         dirname = os.path.basename(path)
         if prefix is None:
             prefix = dirname
         for importer, name, ispkg in pkgutil.walk_packages([path]):
+            filename = None
+            failure = None
+            missing = []
             try:
                 pkg_name = '%s.%s' % (prefix, name)
                 if pkg_name not in sys.modules:
-                    module_meta = importer.find_module(name)
+                    # python 3 loaders only handle the name they were
+                    # found with
+                    module_meta = importer.find_module(pkg_name)
+                    if manifest is not None:
+                        filename = self._module_filename(module_meta,
+                                                         pkg_name)
+                        entry = manifest.get(pkg_name, filename)
+                        # packages are always imported to walk through them
+                        if not ispkg and \
+                           self._skip_module(name, entry, plugins):
+                            continue
                     module = module_meta.load_module(pkg_name)
                 else:
                     module = sys.modules[pkg_name]
                 if ispkg:
-                    self.discover(os.path.join(path, name), pkg_name)
+                    self._discover(os.path.join(path, name), pkg_name,
+                                   manifest, plugins, loaded)
             except PluginFormatError as error:
+                failure = '{0}'.format(error)
                 logging.warn(' *** [{name}] Plugin error: {error}'
                              ''.format(name=name, error=error))
             except PluginLoadError as error:
                 logging.warn(' *** [{name}] Plugin failed to load: {error}'
                              ''.format(name=name, error=error))
+                if self._missing_dependency(error) is not None:
+                    missing.append(self._missing_entry(error))
+                elif self._dependency_failure(error):
+                    if filename is not None:
+                        manifest.remove(pkg_name)
+                    continue
+                else:
+                    failure = '{0}'.format(error)
             except PluginCrashed as error:
+                failure = '{0}'.format(error)
                 logging.warn(' *** [{name}] Plugin crashed: {error}'
                              ''.format(name=name, error=error))
             except ImportError as error:
                 logging.exception(error)
+                # may be fixed without the module changing, do not record
+                if filename is not None:
+                    manifest.remove(pkg_name)
+                continue
+            if filename is not None:
+                loaded.append((pkg_name, filename, failure, missing))
+
+    ##########################################################################
+    # plugin selection
+    ##########################################################################
+
+    @classmethod
+    def invalidate_mimetype_index(cls):
+        """Drop mimetype index, to be called when plugins or states change"""
+        cls.__mimetype_index = None
+        cls.__mimetype_memo.clear()
+
+    # inline flags apply to the whole pattern and backreferences are
+    # numbered from its start: such regexps can not be combined
+    _uncombinable_regexp = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)')
+    # python 2 re does not support more than 100 groups in a pattern
+    _max_groups = 99
+
+    @classmethod
+    def _combine_regexps(cls, plugins):
+        """Compile plugins mimetype regexps into one matcher
+
+        :return: compiled pattern, None if it could not be compiled
+        """
+        pattern = ''.join(r'(?:(?=[\s\S]*?(?P<plugin{0}>{1})))?'
+                          ''.format(i, plugin.plugin_mimetype_regexp)
+                          for i, plugin in enumerate(plugins))
+        try:
+            return re.compile(pattern)
+        except (re.error, AssertionError, OverflowError):
+            # python 2 raises AssertionError on too many groups
+            return None
+
+    @classmethod
+    def _build_mimetype_index(cls):
+        """Compile all active plugins mimetype regexps into one matcher
+
+        Each regexp is wrapped in an optional lookahead with its own named
+        group, so a single match at position 0 tells which regexps would
+        have been found by ``re.search``. As the number of groups of a
+        pattern is limited, regexps are combined in several chunks. Regexps
+        that do not support being combined are kept compiled individually.
+        """
+        plugins = sorted([plugin for plugin in cls.__plugins_cls.values()
+                          if plugin.plugin_active],
+                         key=lambda plugin: plugin.plugin_name)
+        # plugins without regexp handle every mimetype
+        catch_all = []
+        # lists of plugins combined together, with their number of groups
+        chunks = [([], 0)]
+        individual = []
+        for plugin in plugins:
+            regexp = plugin.plugin_mimetype_regexp
+            if regexp is None:
+                catch_all.append(plugin)
+                continue
+            compiled = re.compile(regexp)
+            # one more group wraps the regexp
+            groups = compiled.groups + 1
+            if cls._uncombinable_regexp.search(regexp) or \
+               groups > cls._max_groups:
+                individual.append((compiled, plugin))
+                continue
+            chunk, count = chunks[-1]
+            if count + groups > cls._max_groups:
+                chunk, count = [], 0
+                chunks.append((chunk, count))
+            chunk.append(plugin)
+            chunks[-1] = (chunk, count + groups)
+        combined = []
+        for chunk, _ in chunks:
+            if not chunk:
+                continue
+            matcher = cls._combine_regexps(chunk)
+            if matcher is None:
+                individual.extend((re.compile(plugin.plugin_mimetype_regexp),
+                                   plugin) for plugin in chunk)
+            else:
+                combined.append((matcher, chunk))
+        return catch_all, combined, individual
+
+    def get_plugins_for_mimetype(self, mimetype):
+        """Return active plugins able to handle the given mimetype
+
+        A plugin matches if its mimetype regexp is found in ``mimetype``
+        (``re.search`` semantics) or if it does not define any regexp.
+
+        :param mimetype: mimetype string, as returned by libmagic
+        :return: list of plugin classes sorted by name
+        """
+        mimetype = mimetype or ''
+        cls = self.__class__
+        selected = cls.__mimetype_memo.get(mimetype)
+        if selected is not None:
+            return list(selected)
+        index = cls.__mimetype_index
+        if index is None:
+            index = cls.__mimetype_index = cls._build_mimetype_index()
+        catch_all, combined, individual = index
+        matched = []
+        for matcher, chunk in combined:
+            groups = matcher.match(mimetype).groupdict()
+            matched.extend(plugin for i, plugin in enumerate(chunk)
+                           if groups['plugin{0}'.format(i)] is not None)
+        matched.extend(plugin for regexp, plugin in individual
+                       if regexp.search(mimetype))
+        selected = tuple(sorted(catch_all + matched,
+                                key=lambda plugin: plugin.plugin_name))
+        cls.__mimetype_memo.set(mimetype, selected)
+        return list(selected)
 
     ##########################################################################
     # plugin registering
     ##########################################################################
     @classmethod
-    def register_plugin(cls, plugin):
+    def check_dependencies(cls, plugins, workers=8):
+        """Check dependencies of several plugins concurrently
+
+        Dependencies shared by several plugins are only checked once.
+
+        :param plugins: list of plugin classes
+        :param workers: number of threads running the checks
+        :return: dict mapping each dependency key to its satisfaction
+        """
+        dependencies = {}
+        for plugin in plugins:
+            for dependency in plugin.plugin_dependencies:
+                dependencies.setdefault(dependency.key, dependency)
+        if not dependencies:
+            return {}
+        keys = list(dependencies.keys())
+        pool = ThreadPool(max(1, min(workers, len(keys))))
+        try:
+            results = pool.map(lambda key: dependencies[key].satisfied(),
+                               keys)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(keys, results))
+
+    @classmethod
+    def register_plugins(cls, plugins, workers=8):
+        """Register several plugins, checking their dependencies concurrently
+
+        :param plugins: list of plugin classes
+        :param workers: number of threads running the dependency checks
+        :return: dict mapping plugins that failed to load to their error
+        """
+        results = cls.check_dependencies(plugins, workers)
+        failures = {}
+        for plugin in plugins:
+            try:
+                cls.register_plugin(plugin, results)
+            except PluginLoadError as error:
+                logging.warn(' *** [{name}] Plugin failed to load: {error}'
+                             ''.format(name=plugin.plugin_name, error=error))
+                failures[plugin] = error
+        return failures
+
+    @classmethod
+    def register_plugin(cls, plugin, results=None):
+        """Register a plugin after checking its dependencies
+
+        :param plugin: plugin class
+        :param results: optional table of dependency results, as returned
+            by ``check_dependencies``, used instead of checking them again
+        """
+        if cls.__pending is not None and results is None:
+            logging.debug('Found plugin {name}. Deferring its registration.'
+                          ''.format(name=plugin.plugin_name))
+            cls.__pending.append(plugin)
+            return
         logging.debug('Found plugin {name}. Trying to register it.'
                       ''.format(name=plugin.plugin_name))
         # check for dependencies
         for dependency in plugin.plugin_dependencies:
             try:
-                dependency.check()
+                if results is not None and dependency.key in results:
+                    if not results[dependency.key]:
+                        raise dependency.exception(dependency=dependency)
+                else:
+                    dependency.check()
             except DependencyMissing as error:
                 # get plugin info
                 plugin_name = plugin.plugin_name
@@ -95,10 +437,15 @@ class PluginManager(Singleton):
                 warning = '{name} miss dependencies: {deps} ({type}).'
                 if dependency_help is not None:
                     warning += ' {help}'
-                raise PluginLoadError(warning.format(type=dependency_type,
-                                                     name=plugin_name,
-                                                     deps=dependency_name,
-                                                     help=dependency_help))
+                error = PluginLoadError(warning.format(type=dependency_type,
+                                                       name=plugin_name,
+                                                       deps=dependency_name,
+                                                       help=dependency_help))
+                # lets discovery know the failure may go away without the
+                # module changing
+                error.dependency = dependency
+                error.plugin_name = plugin_name
+                raise error
         # if required, run additionnal verifications on the plugin
         if hasattr(plugin, 'verify'):
             try:
@@ -111,6 +458,7 @@ class PluginManager(Singleton):
                           ''.format(name=plugin.plugin_name))
         else:
             cls.__plugins_cls[plugin.plugin_canonical_name] = plugin
+            cls.invalidate_mimetype_index()
             # mark plugin as active
             if plugin.plugin_active is None:
                 plugin.plugin_active = True
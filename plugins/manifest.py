@@ -0,0 +1,126 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import os
+import json
+import logging
+
+
+##############################################################################
+# Plugin manifest
+##############################################################################
+
+class PluginManifest(object):
+    """On-disk cache of the content of plugin modules
+
+    For each module found during discovery, the manifest records its file
+    and modification time, the names of the plugins it registered, the
+    reason why loading failed if it did and the dependencies its plugins
+    missed. As long as a module file is unchanged, discovery can rely on
+    these data, and only check again the missing dependencies, instead of
+    importing it.
+    """
+
+    # version 1 recorded missing dependencies as module errors, version 2
+    # did not record them at all
+    version = 3
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._dirty = False
+        self.load()
+
+    ##########################################################################
+    # persistence
+    ##########################################################################
+
+    def load(self):
+        self._entries = {}
+        self._dirty = False
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as manifest:
+                content = json.load(manifest)
+            if content.get('version') == self.version:
+                self._entries = content.get('modules', {})
+        except (EnvironmentError, ValueError, AttributeError) as error:
+            logging.warn(' *** Ignoring invalid plugin manifest {path}: '
+                         '{error}'.format(path=self.path, error=error))
+
+    def save(self):
+        if not self._dirty:
+            return
+        content = {'version': self.version, 'modules': self._entries}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as manifest:
+            json.dump(content, manifest, indent=2, sort_keys=True)
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, self.path)
+        else:
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        self._dirty = False
+
+    ##########################################################################
+    # entries
+    ##########################################################################
+
+    @staticmethod
+    def _mtime(filename):
+        try:
+            return os.path.getmtime(filename)
+        except (EnvironmentError, TypeError):
+            return None
+
+    def get(self, module_name, filename):
+        """Return entry of module if its file did not change, else None"""
+        entry = self._entries.get(module_name)
+        if entry is None or filename is None:
+            return None
+        if entry['path'] != filename or \
+           entry['mtime'] != self._mtime(filename):
+            return None
+        return entry
+
+    def update(self, module_name, filename, plugins, error=None,
+               missing=None):
+        """Record the outcome of loading a module
+
+        :param module_name: full name of the module
+        :param filename: file of the module
+        :param plugins: names of the plugins registered by the module
+        :param error: reason why the module failed to load, if any
+        :param missing: list of dicts describing the dependencies missed by
+            plugins of the module, with keys 'plugin' (name of the plugin,
+            None if unknown) and 'dependency' (dependency type and name)
+        """
+        mtime = self._mtime(filename)
+        if mtime is None:
+            return
+        entry = {'path': filename,
+                 'mtime': mtime,
+                 'plugins': sorted(plugins),
+                 'error': error,
+                 'missing': list(missing or [])}
+        if self._entries.get(module_name) != entry:
+            self._entries[module_name] = entry
+            self._dirty = True
+
+    def remove(self, module_name):
+        if self._entries.pop(module_name, None) is not None:
+            self._dirty = True
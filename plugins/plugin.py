@@ -1,10 +1,21 @@
 import os
 import sys
+import time
 import logging
+import threading
+import functools
 
 from sys import platform
 
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+from ..common.oopatterns import Singleton
+from ..plugin_result import PluginResult
 from .manager import PluginManager
+from .pool import peak_rss
 from .exceptions import PluginError
 from .exceptions import PluginLoadError
 from .exceptions import PluginFormatError
@@ -35,6 +46,7 @@ class PluginMetaClass(type):
     _plugin_category_ = ''
     _plugin_active_ = None
     _plugin_mimetype_regexp = None
+    _plugin_batch_size_ = None
 
     ##########################################################################
     # Plugin methods
@@ -91,6 +103,7 @@ class PluginMetaClass(type):
     @plugin_active.setter
     def plugin_active(cls, value):
         cls._plugin_active_ = bool(value)
+        PluginManager.invalidate_mimetype_index()
 
     @property
     def plugin_canonical_name(cls):
@@ -106,5 +119,161 @@ class PluginMetaClass(type):
     def plugin_mimetype_regexp(cls):
         return cls._plugin_mimetype_regexp
 
+    @property
+    def plugin_batch_size(cls):
+        """Maximum number of files given at once to ``run_batch``
+
+        Plugins processing several files faster than one at a time define
+        a ``run_batch(self, filenames)`` method returning one result per
+        file, in order, and set ``_plugin_batch_size_``. None when the
+        plugin does not support batches.
+        """
+        if not callable(getattr(cls, 'run_batch', None)):
+            return None
+        return cls._plugin_batch_size_
+
 # Metaclass compatible with python 2 and 3. Inherit from this for Plugins
 PluginBase = PluginMetaClass('PluginBase', (object,), {})
+
+
+##############################################################################
+# Plugin instrumentation
+##############################################################################
+
+# python 2 has no monotonic clock
+_clock = getattr(time, 'monotonic', time.time)
+
+# linux RUSAGE_THREAD, not exposed by python 2 resource module
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+def _thread_rusage_time():
+    usage = resource.getrusage(_RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+# process wide CPU time would account for the other threads of the pool,
+# so CPU time is not measured where per thread time is not available
+_cpu_time = getattr(time, 'thread_time', None)
+if _cpu_time is None and resource is not None and \
+   platform.startswith('linux'):
+    _cpu_time = _thread_rusage_time
+
+
+class Measure(object):
+    """Wall clock time, CPU time and peak RSS growth of a code block
+
+    Times are given in milliseconds, rss_delta in bytes. cpu_time and
+    rss_delta are None if unknown.
+    """
+
+    def __init__(self):
+        self.duration = None
+        self.cpu_time = None
+        self.rss_delta = None
+
+    def __enter__(self):
+        self._rss = peak_rss()
+        self._cpu = None
+        if _cpu_time is not None:
+            self._cpu = _cpu_time()
+        self._start = _clock()
+        return self
+
+    def __exit__(self, *_):
+        self.duration = round((_clock() - self._start) * 1000, 2)
+        if self._cpu is not None:
+            self.cpu_time = round((_cpu_time() - self._cpu) * 1000, 2)
+        if self._rss is not None:
+            self.rss_delta = peak_rss() - self._rss
+
+
+class PluginMetrics(Singleton):
+    """Process-wide registry of plugin executions metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def record(self, name, measure, failed=False):
+        """Account for an execution of plugin name
+
+        :param name: name of the plugin
+        :param measure: Measure of the execution
+        :param failed: whether the execution raised
+        """
+        with self._lock:
+            metrics = self._metrics.get(name)
+            if metrics is None:
+                metrics = self._metrics[name] = {'calls': 0,
+                                                 'errors': 0,
+                                                 'duration_total': 0.,
+                                                 'duration_min': None,
+                                                 'duration_max': None,
+                                                 'cpu_time_total': 0.,
+                                                 'rss_delta_max': None}
+            metrics['calls'] += 1
+            if failed:
+                metrics['errors'] += 1
+            metrics['duration_total'] += measure.duration
+            if measure.cpu_time is not None:
+                metrics['cpu_time_total'] += measure.cpu_time
+            if metrics['duration_min'] is None or \
+               measure.duration < metrics['duration_min']:
+                metrics['duration_min'] = measure.duration
+            if metrics['duration_max'] is None or \
+               measure.duration > metrics['duration_max']:
+                metrics['duration_max'] = measure.duration
+            if measure.rss_delta is not None and \
+               (metrics['rss_delta_max'] is None or
+                    measure.rss_delta > metrics['rss_delta_max']):
+                metrics['rss_delta_max'] = measure.rss_delta
+
+    def dump(self):
+        """Return a copy of the metrics indexed by plugin name"""
+        with self._lock:
+            return dict((name, dict(metrics))
+                        for name, metrics in self._metrics.items())
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+
+def timed(method):
+    """Decorator measuring a plugin run method
+
+    Wall clock duration, CPU time and peak RSS growth of each call are
+    recorded in the process-wide PluginMetrics registry and, when the
+    method returns a PluginResult, in its ``duration`` (milliseconds),
+    ``cpu_time`` (milliseconds) and ``rss_delta`` (bytes) fields. CPU time
+    is per thread, it is only measured on linux and on python 3.7 and
+    later.
+
+        .. code-block:: python
+
+            class MyPlugin(PluginBase):
+
+                @timed
+                def run(self, filename):
+                    return PluginResult(status=0)
+
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cls = self.__class__
+        name = getattr(cls, 'plugin_name', None) or cls.__name__
+        measure = Measure()
+        try:
+            with measure:
+                result = method(self, *args, **kwargs)
+        except Exception:
+            PluginMetrics().record(name, measure, failed=True)
+            raise
+        PluginMetrics().record(name, measure)
+        if isinstance(result, PluginResult):
+            result.duration = measure.duration
+            result.cpu_time = measure.cpu_time
+            result.rss_delta = measure.rss_delta
+        return result
+    return wrapper
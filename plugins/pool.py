@@ -0,0 +1,212 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import os
+import sys
+import logging
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+def peak_rss():
+    """Return peak resident set size of the process in bytes, None if
+    unknown"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on osx
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def current_rss():
+    """Return resident set size of the process in bytes, None if unknown"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (EnvironmentError, ValueError, IndexError, AttributeError):
+        pass
+    # only the peak is available
+    return peak_rss()
+
+
+##############################################################################
+# Plugin instance pool
+##############################################################################
+
+class _PluginSlot(object):
+    """Instances of a plugin class managed by the pool"""
+
+    def __init__(self):
+        self.idle = []
+        self.alive = 0
+        # id(instance) -> [number of uses, rss when created]
+        self.usage = {}
+        self.condition = threading.Condition()
+
+
+class PluginInstancePool(object):
+    """Pool of initialized plugin instances
+
+    Keeps up to ``size`` instances of each plugin class alive so that
+    expensive initializations (engine loading, signature databases...) are
+    done once and not for every file. Instances are recycled after
+    ``max_uses`` calls or when the process memory grew by more than
+    ``max_memory_growth`` bytes since their creation.
+
+        .. code-block:: python
+
+            pool = PluginInstancePool(size=2, max_uses=1000)
+            with pool.instance(ClamAVPlugin) as plugin:
+                plugin.run(filename)
+
+    """
+
+    def __init__(self, size=1, max_uses=None, max_memory_growth=None):
+        """
+        :param size: maximum number of live instances per plugin class
+        :param max_uses: number of uses after which an instance is recycled
+        :param max_memory_growth: memory growth in bytes, measured on the
+            whole process, after which an instance is recycled
+        """
+        if size < 1:
+            raise ValueError("size must be a positive integer")
+        self.size = size
+        self.max_uses = max_uses
+        self.max_memory_growth = max_memory_growth
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, plugin):
+        with self._lock:
+            if plugin not in self._slots:
+                self._slots[plugin] = _PluginSlot()
+            return self._slots[plugin]
+
+    def _create(self, plugin, slot):
+        logging.debug('Creating instance of plugin {name}'
+                      ''.format(name=plugin.plugin_name))
+        instance = plugin()
+        with slot.condition:
+            slot.usage[id(instance)] = [0, current_rss()]
+        return instance
+
+    def _expired(self, slot, instance):
+        uses, rss = slot.usage[id(instance)]
+        if self.max_uses is not None and uses >= self.max_uses:
+            return True
+        if self.max_memory_growth is not None and rss is not None:
+            current = current_rss()
+            if current is not None and \
+               current - rss > self.max_memory_growth:
+                return True
+        return False
+
+    def warm(self, plugin, count=None):
+        """Create instances of plugin up to count (pool size by default)"""
+        slot = self._slot(plugin)
+        count = min(self.size, count or self.size)
+        while True:
+            with slot.condition:
+                if slot.alive >= count:
+                    return
+                slot.alive += 1
+            try:
+                instance = self._create(plugin, slot)
+            except Exception:
+                with slot.condition:
+                    slot.alive -= 1
+                    slot.condition.notify()
+                raise
+            with slot.condition:
+                slot.idle.append(instance)
+                slot.condition.notify()
+
+    def acquire(self, plugin):
+        """Get an instance of plugin, blocking while all of them are busy
+
+        :param plugin: plugin class
+        :return: plugin instance, to be given back with ``release``
+        """
+        slot = self._slot(plugin)
+        with slot.condition:
+            while not slot.idle and slot.alive >= self.size:
+                slot.condition.wait()
+            if slot.idle:
+                return slot.idle.pop()
+            slot.alive += 1
+        try:
+            return self._create(plugin, slot)
+        except Exception:
+            with slot.condition:
+                slot.alive -= 1
+                slot.condition.notify()
+            raise
+
+    def release(self, plugin, instance, discard=False):
+        """Give back an instance of plugin to the pool
+
+        :param plugin: plugin class
+        :param instance: instance returned by ``acquire``
+        :param discard: drop the instance instead of reusing it (e.g. it
+            may have been left in an inconsistent state)
+        """
+        slot = self._slot(plugin)
+        with slot.condition:
+            slot.usage[id(instance)][0] += 1
+            if discard or self._expired(slot, instance):
+                logging.debug('Recycling instance of plugin {name}'
+                              ''.format(name=plugin.plugin_name))
+                del slot.usage[id(instance)]
+                slot.alive -= 1
+            else:
+                slot.idle.append(instance)
+            slot.condition.notify()
+
+    @contextmanager
+    def instance(self, plugin):
+        """Context manager acquiring and releasing an instance of plugin
+
+        The instance is discarded if the block raises.
+        """
+        instance = self.acquire(plugin)
+        try:
+            yield instance
+        except Exception:
+            self.release(plugin, instance, discard=True)
+            raise
+        self.release(plugin, instance)
+
+    def clear(self, plugin=None):
+        """Drop idle instances of plugin, of every plugin if None"""
+        with self._lock:
+            slots = list(self._slots.items())
+        for cls, slot in slots:
+            if plugin is not None and cls is not plugin:
+                continue
+            with slot.condition:
+                for instance in slot.idle:
+                    del slot.usage[id(instance)]
+                slot.alive -= len(slot.idle)
+                slot.idle = []
+                slot.condition.notify_all()
@@ -7,7 +7,9 @@
 import os
 import sys
 import stat
+import time
 import tempfile
+import threading
 
 
 def is_case_sensitive_filesystem():
@@ -20,6 +22,21 @@ def is_case_sensitive_filesystem():
 _IS_CASE_SENSITIVE_FILESYSTEM = is_case_sensitive_filesystem()
 
 
+def is_exe(fpath):
+    """
+        Return true if fpath is a file we have access to
+        that is executable
+    """
+    accessmode = os.F_OK | os.X_OK
+    if os.path.exists(fpath) and os.access(fpath, accessmode) and \
+       not os.path.isdir(fpath):
+        filemode = os.stat(fpath).st_mode
+        ret = bool(filemode & stat.S_IXUSR or
+                   filemode & stat.S_IXGRP or
+                   filemode & stat.S_IXOTH)
+        return ret
+
+
 def which(program, case_sensitive=_IS_CASE_SENSITIVE_FILESYSTEM):
     """
         Simulates unix `which` command.
@@ -27,20 +44,6 @@ def which(program, case_sensitive=_IS_CASE_SENSITIVE_FILESYSTEM):
         Returns absolute path if program found
     """
 
-    def is_exe(fpath):
-        """
-            Return true if fpath is a file we have access to
-            that is executable
-        """
-        accessmode = os.F_OK | os.X_OK
-        if os.path.exists(fpath) and os.access(fpath, accessmode) and \
-           not os.path.isdir(fpath):
-            filemode = os.stat(fpath).st_mode
-            ret = bool(filemode & stat.S_IXUSR or
-                       filemode & stat.S_IXGRP or
-                       filemode & stat.S_IXOTH)
-            return ret
-
     def list_file_exts(directory, search_filename=None, ignore_case=True):
         """
             Return list of (filename, extension) tuples which match
@@ -99,3 +102,148 @@ def which(program, case_sensitive=_IS_CASE_SENSITIVE_FILESYSTEM):
                     return exe_file
 
     return None
+
+
+class PathIndex(object):
+    """
+        Index of the files found in PATH directories
+
+        Each directory is listed once and its listing reused as long as its
+        modification time does not change, so that resolving a program does
+        not stat every candidate of every directory like `which` does.
+        Resolution order is the same as `which`: exact name, then name with
+        each PATHEXT extension, then "soft" extension search.
+    """
+
+    def __init__(self, case_sensitive=_IS_CASE_SENSITIVE_FILESYSTEM,
+                 ttl=1.0):
+        """
+            case_sensitive: whether file names are compared case sensitively
+            ttl: seconds during which directories are not checked for
+                 modification again
+        """
+        self.case_sensitive = case_sensitive
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._environ = None
+        self._paths = []
+        self._exe_exts = []
+        self._listings = {}
+        self._resolved = {}
+        self._checked = None
+
+    def _normalize(self, name):
+        return name if self.case_sensitive else name.lower()
+
+    def _list(self, path):
+        """
+            Return (mtime, {name: filename}, {stem: [filenames]}) of path
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+            filenames = os.listdir(path)
+        except (EnvironmentError, TypeError, ValueError):
+            return (None, {}, {})
+        names = {}
+        stems = {}
+        for filename in filenames:
+            names.setdefault(self._normalize(filename), filename)
+            stem = self._normalize(os.path.splitext(filename)[0])
+            stems.setdefault(stem, []).append(filename)
+        return (mtime, names, stems)
+
+    def _refresh(self):
+        """
+            Reload the directories whose content changed since last call
+        """
+        environ = (os.environ.get("PATH", ""), os.environ.get("PATHEXT", ""))
+        now = time.time()
+        if environ == self._environ and self._checked is not None and \
+           now - self._checked < self.ttl:
+            return
+        if environ != self._environ:
+            self._environ = environ
+            self._paths = [path.strip('"')
+                           for path in environ[0].split(os.pathsep)]
+            self._exe_exts = [self._normalize(ext)
+                              for ext in environ[1].split(os.pathsep)]
+            self._listings = {}
+            self._resolved = {}
+        for path in self._paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except (EnvironmentError, TypeError, ValueError):
+                mtime = None
+            listing = self._listings.get(path)
+            if listing is None or listing[0] != mtime:
+                self._listings[path] = self._list(path)
+                self._resolved = {}
+        self._checked = now
+
+    def _resolve(self, program):
+        name = self._normalize(program)
+        # try program name per directory
+        for path in self._paths:
+            if name in self._listings[path][1]:
+                exe_file = os.path.join(path, program)
+                if is_exe(exe_file):
+                    return exe_file
+        # try with known executable extensions per directory
+        for path in self._paths:
+            names = self._listings[path][1]
+            for extension in self._exe_exts:
+                if name + extension in names:
+                    exe_file = os.path.join(path, names[name + extension])
+                    if is_exe(exe_file):
+                        return exe_file
+        # try search program name with "soft" extension search
+        if len(os.path.splitext(program)[1]) == 0:
+            for path in self._paths:
+                for filename in self._listings[path][2].get(name, []):
+                    exe_file = os.path.join(path, filename)
+                    if is_exe(exe_file):
+                        return exe_file
+        return None
+
+    def which(self, program):
+        """
+            Indexed equivalent of `which`
+
+            Returns absolute path if program found
+        """
+        fpath, fname = os.path.split(program)
+        # paths are not indexed
+        if fpath:
+            return which(program, self.case_sensitive)
+        # neither is the current directory searched first on windows
+        if sys.platform.startswith("win") and is_exe(fname):
+            return program
+        with self._lock:
+            self._refresh()
+            exe_file = self._resolved.get(program)
+            # permissions may change without altering the directory
+            if exe_file is None or not is_exe(exe_file):
+                exe_file = self._resolve(program)
+                self._resolved[program] = exe_file
+            return exe_file
+
+    def invalidate(self):
+        """
+            Forget every listing, they will be reloaded on next call
+        """
+        with self._lock:
+            self._environ = None
+            self._listings = {}
+            self._resolved = {}
+
+
+_PATH_INDEX = PathIndex()
+
+
+def indexed_which(program):
+    """
+        Simulates unix `which` command using the process-wide PathIndex
+
+        Returns absolute path if program found
+    """
+    return _PATH_INDEX.which(program)
@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import logging
+import unittest
+import tempfile
+import os
+
+from common.cache import LRUCache, SQLiteCache
+
+
+# =================
+#  Logging options
+# =================
+
+def enable_logging(level=logging.INFO, handler=None, formatter=None):
+    global log
+    log = logging.getLogger()
+    if formatter is None:
+        formatter = logging.Formatter("%(asctime)s [%(name)s] " +
+                                      "%(levelname)s: %(message)s")
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+    log.setLevel(level)
+
+
+# ============
+#  Test Cases
+# ============
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", 2), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate_clear(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate("a")
+        self.assertNotIn("a", cache)
+        cache.get("b")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            LRUCache(0)
+
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix="test_cache")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_persistence(self):
+        cache = SQLiteCache(self.path)
+        cache.set("a", "1")
+        cache.set("a", "2")
+        cache.close()
+        cache = SQLiteCache(self.path)
+        self.assertEqual(cache.get("a"), "2")
+        self.assertIsNone(cache.get("b"))
+        cache.close()
+
+    def test_invalidate_clear(self):
+        cache = SQLiteCache(self.path, table="other")
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+        cache.close()
+
+
+if __name__ == '__main__':
+    enable_logging()
+    unittest.main()
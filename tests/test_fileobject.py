@@ -15,6 +15,7 @@
 
 import logging
 import unittest
+from io import BytesIO
 from irma.common.exceptions import IrmaDatabaseError
 from irma.database.nosqlhandler import NoSQLDatabase
 from irma.fileobject.handler import FileObject
@@ -33,6 +34,13 @@ class TestObject(FileObject):
     _collection = test_db_collection
 
 
+class DedupTestObject(FileObject):
+    _uri = test_db_uri
+    _dbname = test_db_name
+    _collection = test_db_collection_files
+    _dedup = True
+
+
 # =================
 #  Logging options
 # =================
@@ -118,6 +126,93 @@ class TestFileObject(DbTestCase):
         with self.assertRaises(IrmaDatabaseError):
             t.data
 
+    def test_data_twice(self):
+        t = TestObject()
+        data = 'Some awesome data'
+        t.save(data, 'AName')
+        self.assertEqual(t.data, data)
+        self.assertEqual(t.data, data)
+
+    def test_save_file_object(self):
+        t = TestObject()
+        data = 'streamed data' * 100000
+        t.save(BytesIO(data), 'AName')
+        t2 = TestObject(id=t.id)
+        self.assertEqual(t2.size, len(data))
+        self.assertEqual(t2.data, data)
+
+    def test_chunks(self):
+        t = TestObject()
+        data = 'chunked data' * 100000
+        t.save(data, 'AName')
+        chunks = list(t.chunks())
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(''.join(t.chunks(chunk_size=1000)), data)
+        self.assertEqual(''.join(t.chunks(start=10, end=1000)),
+                         data[10:1000])
+
+    def test_range_reads(self):
+        t = TestObject()
+        data = 'range data' * 100000
+        t.save(data, 'AName')
+        self.assertEqual(t.read_range(300000, 42), data[300000:300042])
+        self.assertEqual(t.read_range(len(data) - 5), data[-5:])
+        buf = bytearray(100)
+        self.assertEqual(t.readinto(buf, 500), 100)
+        self.assertEqual(bytes(buf), data[500:600])
+        self.assertEqual(t.readinto(buf, len(data) - 10), 10)
+        self.assertEqual(bytes(buf[:10]), data[-10:])
+        self.assertEqual(t.readinto(buf), 0)
+
+
+class TestDedupFileObject(DbTestCase):
+    def tearDown(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        db.db_instance()[test_db_name].drop_collection(
+            test_db_collection_files + ".files")
+        db.db_instance()[test_db_name].drop_collection(
+            test_db_collection_files + ".chunks")
+
+    def test_same_content_stored_once(self):
+        data = 'resubmitted data'
+        t1 = DedupTestObject()
+        t1.save(data, 'first')
+        t2 = DedupTestObject()
+        t2.save(BytesIO(data), 'second')
+        self.assertEqual(t1.id, t2.id)
+        self.assertEqual(DedupTestObject(id=t1.id)._dbfile.refcount, 2)
+        t3 = DedupTestObject()
+        t3.save('other data', 'third')
+        self.assertNotEqual(t1.id, t3.id)
+
+    def test_non_seekable_stream(self):
+        class Stream(object):
+            def __init__(self, data):
+                self.fileobj = BytesIO(data)
+
+            def read(self, size=-1):
+                return self.fileobj.read(size)
+        data = 'streamed data' * 100000
+        t1 = DedupTestObject()
+        t1.save(data, 'first')
+        t2 = DedupTestObject()
+        t2.save(Stream(data), 'second')
+        self.assertEqual(t1.id, t2.id)
+        self.assertEqual(t2.data, data)
+
+    def test_delete_references(self):
+        data = 'shared data'
+        t1 = DedupTestObject()
+        t1.save(data, 'first')
+        t2 = DedupTestObject()
+        t2.save(data, 'second')
+        t1.delete()
+        self.assertEqual(DedupTestObject(id=t2.id).data, data)
+        t2.delete()
+        with self.assertRaises(IrmaDatabaseError):
+            DedupTestObject(id=t2.id)
+
 if __name__ == '__main__':
     enable_logging()
     unittest.main()
@@ -19,8 +19,11 @@ import unittest
 import os
 import random
 from common.hash import md5sum, sha1sum, sha224sum, sha256sum, sha384sum, \
-    sha512sum
-from tempfile import TemporaryFile
+    sha512sum, multisum
+from common.hash import md5sum_path, sha1sum_path, sha224sum_path, \
+    sha256sum_path, sha384sum_path, sha512sum_path, multisum_path
+from common.hash import hash_many, DigestCache, Hasher
+from tempfile import TemporaryFile, mkstemp
 
 
 # =================
@@ -89,6 +92,207 @@ class TestHashsum(HashTestCase):
         self.assertEqual(hash1, hash2)
 
 
+class TestMultisum(HashTestCase):
+
+    def test_multisum_default(self):
+        digests = multisum(self.fobj)
+        self.assertEqual(sorted(digests.keys()), ['md5', 'sha1', 'sha256'])
+        self.assertEqual(digests['md5'], hashlib.md5(self.data).hexdigest())
+        self.assertEqual(digests['sha1'], hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(digests['sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+
+    def test_multisum_matches_single_sums(self):
+        digests = multisum(self.fobj, ['sha224', 'sha384', 'sha512'])
+        self.assertEqual(digests['sha224'], sha224sum(self.fobj))
+        self.assertEqual(digests['sha384'], sha384sum(self.fobj))
+        self.assertEqual(digests['sha512'], sha512sum(self.fobj))
+
+    def test_multisum_constructors(self):
+        digests = multisum(self.fobj, [hashlib.md5, hashlib.sha256])
+        self.assertEqual(digests['md5'], md5sum(self.fobj))
+        self.assertEqual(digests['sha256'], sha256sum(self.fobj))
+
+    def test_multisum_rewinds(self):
+        multisum(self.fobj)
+        self.assertEqual(self.fobj.tell(), 0)
+
+    def test_multisum_empty(self):
+        self.assertEqual(multisum(self.fobj, []), {})
+
+
+class ReadOnlyStream(object):
+    """file-like object without readinto support"""
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+
+    def read(self, size=-1):
+        return self.fobj.read(size)
+
+    def seek(self, offset):
+        return self.fobj.seek(offset)
+
+
+class TestHashsumStreams(HashTestCase):
+
+    def test_hashsum_without_readinto(self):
+        stream = ReadOnlyStream(self.fobj)
+        self.assertEqual(sha256sum(stream),
+                         hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(multisum(stream, ['md5'])['md5'],
+                         hashlib.md5(self.data).hexdigest())
+
+
+class HashPathTestCase(HashTestCase):
+
+    def setUp(self):
+        super(HashPathTestCase, self).setUp()
+        fd, self.path = mkstemp(prefix="test_hash")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        super(HashPathTestCase, self).tearDown()
+        os.remove(self.path)
+
+
+class TestHashsumPath(HashPathTestCase):
+
+    def test_hashsum_path(self):
+        for sum_path, sum_fobj in [(md5sum_path, md5sum),
+                                   (sha1sum_path, sha1sum),
+                                   (sha224sum_path, sha224sum),
+                                   (sha256sum_path, sha256sum),
+                                   (sha384sum_path, sha384sum),
+                                   (sha512sum_path, sha512sum)]:
+            self.assertEqual(sum_path(self.path), sum_fobj(self.fobj))
+
+    def test_hashsum_path_empty_file(self):
+        with open(self.path, "wb"):
+            pass
+        self.assertEqual(sha256sum_path(self.path),
+                         hashlib.sha256(b'').hexdigest())
+
+    def test_multisum_path(self):
+        self.assertEqual(multisum_path(self.path), multisum(self.fobj))
+
+
+class TestHashMany(HashPathTestCase):
+
+    def test_hash_many_paths(self):
+        paths = [self.path] * 10
+        results = list(hash_many(paths, hashlib.sha256, workers=3))
+        self.assertEqual(len(results), 10)
+        for item, digest in results:
+            self.assertEqual(item, self.path)
+            self.assertEqual(digest, sha256sum_path(self.path))
+
+    def test_hash_many_fileobjs(self):
+        results = list(hash_many([self.fobj], 'md5', workers=1))
+        self.assertEqual(results, [(self.fobj, md5sum(self.fobj))])
+
+    def test_hash_many_error(self):
+        missing = self.path + ".missing"
+        with self.assertRaises(EnvironmentError):
+            list(hash_many([self.path, missing], 'sha1', workers=2))
+
+    def test_hash_many_early_exit(self):
+        results = hash_many([self.path] * 100, 'sha1', workers=2)
+        item, digest = next(results)
+        self.assertEqual(digest, sha1sum_path(self.path))
+        results.close()
+
+
+class TestDigestCache(HashPathTestCase):
+
+    def test_digest_cache_hit(self):
+        cache = DigestCache()
+        digest = cache.hexdigest(self.path, 'sha256')
+        self.assertEqual(digest, sha256sum_path(self.path))
+        self.assertEqual(cache.hexdigest(self.path, hashlib.sha256), digest)
+        self.assertEqual((cache.memory.hits, cache.memory.misses), (1, 1))
+
+    def test_digest_cache_modified_file(self):
+        cache = DigestCache()
+        cache.hexdigest(self.path, 'md5')
+        with open(self.path, "ab") as f:
+            f.write(b"more data")
+        self.assertEqual(cache.hexdigest(self.path, 'md5'),
+                         md5sum_path(self.path))
+        self.assertEqual(cache.memory.hits, 0)
+
+    def test_digest_cache_invalidate(self):
+        cache = DigestCache()
+        cache.hexdigest(self.path)
+        cache.invalidate(self.path)
+        cache.hexdigest(self.path)
+        self.assertEqual(cache.memory.misses, 2)
+
+    def test_digest_cache_disk(self):
+        fd, db_path = mkstemp(prefix="test_hash_db")
+        os.close(fd)
+        try:
+            digest = DigestCache(path=db_path).hexdigest(self.path)
+            cache = DigestCache(path=db_path)
+            self.assertEqual(cache.disk.get(cache._key(os.stat(self.path),
+                                                       'sha256')), digest)
+            self.assertEqual(cache.hexdigest(self.path), digest)
+            self.assertEqual(cache.memory.misses, 1)
+        finally:
+            os.remove(db_path)
+
+    def test_hash_many_with_cache(self):
+        cache = DigestCache()
+        results = list(hash_many([self.path] * 5, 'sha1', workers=1,
+                                 cache=cache))
+        self.assertEqual(results, [(self.path, sha1sum_path(self.path))] * 5)
+        self.assertEqual(cache.memory.hits, 4)
+
+
+class TestHasher(HashTestCase):
+
+    def test_hasher_chunks(self):
+        hasher = Hasher()
+        for i in range(0, len(self.data), 1000):
+            hasher(self.data[i:i + 1000])
+        self.assertEqual(hasher.size, len(self.data))
+        self.assertEqual(hasher.hexdigest(), sha256sum(self.fobj))
+
+    def test_hasher_multiple_algorithms(self):
+        hasher = Hasher(['md5', 'sha1'])
+        hasher.update(self.data)
+        self.assertEqual(hasher.algorithms, ['md5', 'sha1'])
+        self.assertEqual(hasher.hexdigests(), multisum(self.fobj,
+                                                       ['md5', 'sha1']))
+        with self.assertRaises(ValueError):
+            hasher.hexdigest()
+
+    def test_hasher_fileobj(self):
+        hasher = Hasher(['sha512'])
+        self.fobj.seek(0)
+        self.assertEqual(hasher.update_from_fileobj(self.fobj),
+                         len(self.data))
+        self.assertEqual(hasher.hexdigest('sha512'), sha512sum(self.fobj))
+
+    def test_hasher_copy(self):
+        hasher = Hasher()
+        hasher.update(self.data[:10])
+        snapshot = hasher.copy()
+        hasher.update(self.data[10:])
+        snapshot.update(b"other")
+        self.assertEqual(hasher.hexdigest(),
+                         hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(snapshot.hexdigest(),
+                         hashlib.sha256(self.data[:10] +
+                                        b"other").hexdigest())
+        self.assertEqual(snapshot.size, 15)
+
+    def test_hasher_no_algorithm(self):
+        with self.assertRaises(ValueError):
+            Hasher([])
+
+
 if __name__ == '__main__':
     enable_logging()
     unittest.main()
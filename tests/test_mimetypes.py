@@ -14,12 +14,14 @@
 # terms contained in the LICENSE file.
 
 import logging
+import sys
 import unittest
 import tempfile
+import threading
 import os
 
 import magic
-from common.mimetypes import Magic
+from common.mimetypes import Magic, MimetypeCache
 
 
 # =================
@@ -90,6 +92,126 @@ class TestMimetype(MimetypesTestCase):
         mime2 = self.cookie.file(self.filename)
         self.assertEqual(mime1, mime2)
 
+    def test_cookie_reuse(self):
+        kwargs = dict(mime=True, mime_encoding=True, keep_going=True)
+        Magic.from_buffer(self.data, **kwargs)
+        key, cookie = Magic._acquire(**kwargs)
+        Magic._release(key, cookie)
+        Magic.from_file(self.filename, **kwargs)
+        key2, cookie2 = Magic._acquire(**kwargs)
+        Magic._release(key2, cookie2)
+        self.assertEqual(key, key2)
+        self.assertIs(cookie, cookie2)
+
+    def test_cookie_flags(self):
+        key, cookie = Magic._acquire(mime=True)
+        Magic._release(key, cookie)
+        key2, cookie2 = Magic._acquire(mime=False)
+        Magic._release(key2, cookie2)
+        self.assertNotEqual(key, key2)
+        self.assertIsNot(cookie, cookie2)
+
+    def test_concurrent_threads(self):
+        expected = self.cookie.buffer(self.data)
+        results = []
+
+        def detect():
+            for _ in range(20):
+                results.append(Magic.from_buffer(self.data,
+                                                 mime=True,
+                                                 mime_encoding=True,
+                                                 keep_going=True))
+        threads = [threading.Thread(target=detect) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 80)
+
+    def test_from_files(self):
+        expected = self.cookie.buffer(self.data)
+        missing = self.filename + ".missing"
+        mimes = Magic.from_files([self.filename, missing, self.filename],
+                                 workers=2,
+                                 mime=True,
+                                 mime_encoding=True,
+                                 keep_going=True)
+        self.assertEqual(mimes, [expected, None, expected])
+
+    def test_from_files_head_bytes(self):
+        mimes = Magic.from_files([self.filename], head_bytes=4)
+        self.assertEqual(mimes, [Magic.from_buffer(self.data[:4])])
+
+    def test_from_files_from_file(self):
+        filenames = [self.filename, sys.executable]
+        mimes = Magic.from_files(filenames, workers=2)
+        self.assertEqual(mimes, [Magic.from_file(filename)
+                                 for filename in filenames])
+
+
+class TestMimetypeCache(MimetypesTestCase):
+
+    def tearDown(self):
+        super(TestMimetypeCache, self).tearDown()
+        Magic.disable_cache()
+
+    def test_cache_hit(self):
+        cache = Magic.enable_cache()
+        mime1 = Magic.from_buffer(self.data, mime=True)
+        mime2 = Magic.from_buffer(self.data, mime=True)
+        self.assertEqual(mime1, mime2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_cache_known_digest(self):
+        cache = Magic.enable_cache()
+        Magic.from_buffer(self.data, digest="0" * 64)
+        # a known digest short-circuits detection
+        mime = Magic.from_buffer("not a pdf", digest="0" * 64)
+        self.assertEqual(mime, Magic.from_buffer(self.data))
+        self.assertEqual(cache.hits, 1)
+
+    def test_cache_flags(self):
+        cache = Magic.enable_cache()
+        Magic.from_buffer(self.data, mime=True)
+        Magic.from_buffer(self.data, mime=False)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_cache_persistence(self):
+        _, db_path = tempfile.mkstemp(prefix="test_magic_db")
+        try:
+            Magic.enable_cache(path=db_path)
+            mime = Magic.from_buffer(self.data)
+            cache = Magic.enable_cache(path=db_path)
+            self.assertEqual(Magic.from_buffer(self.data), mime)
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(cache.memory.misses, 1)
+        finally:
+            os.remove(db_path)
+
+    def test_cache_clear(self):
+        cache = MimetypeCache(maxsize=2)
+        cache.set("key", "application/pdf")
+        self.assertEqual(cache.get("key"), "application/pdf")
+        cache.clear()
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_cache_concurrent_counters(self):
+        cache = MimetypeCache(maxsize=2)
+        cache.set("key", "application/pdf")
+
+        def lookup():
+            for _ in range(1000):
+                cache.get("key")
+                cache.get("missing")
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((cache.hits, cache.misses), (4000, 4000))
+
+
 if __name__ == '__main__':
     enable_logging()
     unittest.main()
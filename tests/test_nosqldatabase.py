@@ -208,6 +208,62 @@ class TestNoSQLDatabaseObject(DbTestCase):
         self.assertIsInstance(t1.__str__(), str)
 
 
+class TestBulkOperations(DbTestCase):
+    def test_bulk_save(self):
+        objects = [{'user': "user{0}".format(i)} for i in range(10)]
+        ids = self.db.bulk_save(test_db_name, test_db_collection, objects,
+                                batch_size=3)
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(self.collection.count(), 10)
+        self.assertEqual([obj['_id'] for obj in objects], ids)
+        # saving again replaces existing entries
+        objects[0]['user'] = "coin"
+        self.db.bulk_save(test_db_name, test_db_collection, objects[:1])
+        self.assertEqual(self.collection.count(), 10)
+        self.assertEqual(self.collection.find_one({'_id': ids[0]})['user'],
+                         "coin")
+
+    def test_bulk_update(self):
+        t1, t2 = TestObject(), TestObject()
+        self.db.bulk_update(test_db_name, test_db_collection,
+                            [(t1._id, {'user': "coin"}),
+                             (t2._id, {'user': "bla"})],
+                            batch_size=1)
+        self.assertEqual(TestObject(id=t1.id).user, "coin")
+        self.assertEqual(TestObject(id=t2.id).user, "bla")
+
+    def test_bulk_remove(self):
+        objects = [TestObject() for _ in range(5)]
+        self.db.bulk_remove(test_db_name, test_db_collection,
+                            [obj._id for obj in objects[:4]],
+                            batch_size=2)
+        self.assertEqual(self.collection.count(), 1)
+
+    def test_unit_of_work(self):
+        t1, t2 = TestObject(), TestObject()
+        with TestObject.unit_of_work():
+            t1.update({'user': "coin"})
+            t1.update({'list': [1, 2]})
+            t2.update({'user': "bla"})
+            # nothing written before the end of the unit of work
+            self.assertEqual(TestObject(id=t1.id).user, "test")
+        t3 = TestObject(id=t1.id)
+        self.assertEqual(t3.user, "coin")
+        self.assertEqual(t3.list, [1, 2])
+        self.assertEqual(TestObject(id=t2.id).user, "bla")
+
+    def test_unit_of_work_error(self):
+        t1 = TestObject()
+        with self.assertRaises(ValueError):
+            with TestObject.unit_of_work():
+                t1.update({'user': "coin"})
+                raise ValueError()
+        self.assertEqual(TestObject(id=t1.id).user, "test")
+        # updates are not buffered anymore
+        t1.update({'user': "bla"})
+        self.assertEqual(TestObject(id=t1.id).user, "bla")
+
+
 if __name__ == '__main__':
     enable_logging()
     unittest.main()
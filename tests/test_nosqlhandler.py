@@ -15,8 +15,11 @@
 
 import logging
 import unittest
+import threading
+from irma.common.exceptions import IrmaDatabaseError
 from irma.database.nosqlhandler import NoSQLDatabase
 from pymongo import MongoClient
+from pymongo.errors import AutoReconnect
 
 # Test config
 test_db_uri = "mongodb://irma.test"
@@ -85,5 +88,146 @@ class CheckNoSQLDatabase(NoSQLDatabaseTestCase):
         with NoSQLDatabase(test_db_name, test_db_uri) as db:
             db._disconnect()
 
+    def test_singleton_per_database(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        self.assertIs(db, NoSQLDatabase(test_db_name, test_db_uri))
+        self.assertIs(db, NoSQLDatabase(db_name=test_db_name,
+                                        db_uri=test_db_uri))
+        other = NoSQLDatabase(test_db_name + "_other", test_db_uri)
+        self.assertIsNot(db, other)
+        other_uri = NoSQLDatabase(test_db_name, test_db_uri + ":27018")
+        self.assertIsNot(db, other_uri)
+
+    def test_singleton_threads(self):
+        instances = []
+        name = test_db_name + "_threads"
+
+        def create():
+            instances.append(NoSQLDatabase(name, test_db_uri))
+        threads = [threading.Thread(target=create) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(id(db) for db in instances)), 1)
+
+    def test_connect_when_connected(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        if not db._is_connected():
+            db._connect()
+        client = db.db_instance()
+        db._connect()
+        self.assertIs(client, db.db_instance())
+
+    def test_reconnect_after_reset(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        if not db._is_connected():
+            db._connect()
+        db._disconnect()
+        # cursors are lazy, no server is needed
+        db.find(test_db_name, test_db_collection, {})
+        self.assertTrue(db._is_connected())
+
+    def test_concurrent_resets(self):
+        name = test_db_name + "_resets"
+        db = NoSQLDatabase(name, test_db_uri, retries=100, retry_delay=0)
+        errors = []
+
+        def reset_and_query():
+            try:
+                for _ in range(20):
+                    db._reset(db.db_instance())
+                    db.find(name, test_db_collection, {})
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=reset_and_query)
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_client_options(self):
+        db = NoSQLDatabase(test_db_name + "_pool", test_db_uri,
+                           maxPoolSize=7, connectTimeoutMS=1500)
+        if not db._is_connected():
+            db._connect()
+        client = db.db_instance()
+        self.assertIsInstance(client, MongoClient)
+        self.assertEqual(client.max_pool_size, 7)
+
+    def test_connect_retries(self):
+        # invalid options make every connection attempt fail
+        self.assertRaises(IrmaDatabaseError, NoSQLDatabase,
+                          test_db_name + "_invalid", test_db_uri,
+                          retries=2, retry_delay=0, maxPoolSize=-1)
+
+    def test_table_cache(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        if not db._is_connected():
+            db._connect()
+        coll = db._table(test_db_name, test_db_collection)
+        self.assertIs(coll, db._table(test_db_name, test_db_collection))
+        other = db._table(test_db_name + "_other", test_db_collection)
+        self.assertIsNot(coll, other)
+        self.assertEqual(coll.database.name, test_db_name)
+        self.assertEqual(other.database.name, test_db_name + "_other")
+
+    def test_gridfs_cache(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        if not db._is_connected():
+            db._connect()
+        fs = db._gridfs(test_db_name, test_db_collection)
+        self.assertIs(fs, db._gridfs(test_db_name, test_db_collection))
+        self.assertIsNot(fs, db._gridfs(test_db_name + "_other",
+                                        test_db_collection))
+        bucket = db._gridfs_bucket(test_db_name, test_db_collection)
+        self.assertIs(bucket,
+                      db._gridfs_bucket(test_db_name, test_db_collection))
+        db._disconnect()
+        db._connect()
+        self.assertIsNot(fs, db._gridfs(test_db_name, test_db_collection))
+
+    def test_backoff_bounded(self):
+        db = NoSQLDatabase(test_db_name, test_db_uri)
+        delays = [db._backoff(attempt) for attempt in range(10)]
+        self.assertEqual(delays, sorted(delays))
+        self.assertEqual(delays[0], db._retry_delay)
+        self.assertEqual(max(delays), db._max_retry_delay)
+
+    def test_put_file_not_retried(self):
+        db = NoSQLDatabase(test_db_name + "_put", test_db_uri,
+                           retries=3, retry_delay=0)
+        calls = []
+
+        class FailingGridFS(object):
+            def put(self, data, **kwargs):
+                calls.append(data)
+                raise AutoReconnect("connection lost")
+        db._gridfs = lambda db_name, collection_name: FailingGridFS()
+        try:
+            self.assertRaises(IrmaDatabaseError, db.put_file,
+                              test_db_name, test_db_collection,
+                              "data", "name")
+        finally:
+            del db._gridfs
+        # the file may have been stored, it must not be sent again
+        self.assertEqual(calls, ["data"])
+
+    def test_bulk_save_generator(self):
+        db = NoSQLDatabase(test_db_name + "_bulk", test_db_uri)
+        written = []
+        db._bulk_write = lambda collection, operations, batch_size: \
+            written.extend(operations)
+        try:
+            ids = db.bulk_save(test_db_name, test_db_collection,
+                               ({'value': i} for i in range(3)))
+        finally:
+            del db._bulk_write
+        self.assertEqual(len(ids), 3)
+        self.assertEqual([op[1] for op in written], ids)
+        self.assertEqual([op[2]['value'] for op in written], [0, 1, 2])
+
 if __name__ == '__main__':
     unittest.main()
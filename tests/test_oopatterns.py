@@ -13,7 +13,9 @@
 # modified, propagated, or distributed except according to the
 # terms contained in the LICENSE file.
 
+import time
 import logging
+import threading
 import unittest
 
 from common.oopatterns import Singleton, ParametricSingleton, Plugin
@@ -230,6 +232,54 @@ class CheckParametricSingleton(unittest.TestCase):
         self.assertEquals(id(obj1), id(obj3))
         self.assertNotEquals(id(obj2), id(obj3))
 
+    def test_concurrent_same_key(self):
+
+        class ParametricSingleton1(ParametricSingleton):
+            depends_on = staticmethod(lambda cls, args, kwargs: args[0])
+
+            def __init__(self, key):
+                # give other threads a chance to build it too
+                threading.Event().wait(0.05)
+
+        instances = []
+        threads = [threading.Thread(
+            target=lambda: instances.append(ParametricSingleton1("key")))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, instances))), 1)
+
+    def test_concurrent_other_key(self):
+        building = threading.Event()
+        release = threading.Event()
+
+        class ParametricSingleton1(ParametricSingleton):
+            depends_on = staticmethod(lambda cls, args, kwargs: args[0])
+
+            def __init__(self, key):
+                if key == "slow" and type(self) is ParametricSingleton1:
+                    building.set()
+                    release.wait(5)
+
+        class ParametricSingleton2(ParametricSingleton1):
+            pass
+
+        thread = threading.Thread(target=ParametricSingleton1,
+                                  args=("slow",))
+        thread.start()
+        try:
+            building.wait(5)
+            # neither blocked by the instance being built
+            start = time.time()
+            self.assertIsNotNone(ParametricSingleton1("fast"))
+            self.assertIsNotNone(ParametricSingleton2("slow"))
+            self.assertLess(time.time() - start, 1)
+        finally:
+            release.set()
+            thread.join()
+
 
 # ========================
 #  Test Cases for Plugins
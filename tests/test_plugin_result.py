@@ -0,0 +1,188 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import json
+import pickle
+import logging
+import unittest
+
+import plugin_result
+from plugin_result import PluginResult, PluginResultAggregator
+
+
+# =================
+#  Logging options
+# =================
+
+def enable_logging(level=logging.INFO, handler=None, formatter=None):
+    global log
+    log = logging.getLogger()
+    if formatter is None:
+        formatter = logging.Formatter("%(asctime)s [%(name)s] " +
+                                      "%(levelname)s: %(message)s")
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+    log.setLevel(level)
+
+
+# ============
+#  Test Cases
+# ============
+
+class TestPluginResult(unittest.TestCase):
+
+    def test_defaults(self):
+        result = PluginResult(name="probe")
+        self.assertIsInstance(result, dict)
+        self.assertEqual(result.name, "probe")
+        self.assertEqual(result["status"], -1)
+        self.assertIsNone(result.error)
+        self.assertEqual(set(result), set(PluginResult.fields))
+
+    def test_no_instance_dict(self):
+        result = PluginResult()
+        self.assertFalse(hasattr(result, "__dict__"))
+
+    def test_attribute_and_item_access(self):
+        result = PluginResult(name="probe", custom=1)
+        self.assertEqual(result.custom, 1)
+        self.assertEqual(result["custom"], 1)
+        self.assertIsNone(result.unknown)
+        self.assertRaises(KeyError, result.__getitem__, "unknown")
+        result.status = 0
+        self.assertEqual(result["status"], 0)
+        result["results"] = ["a"]
+        self.assertEqual(result.results, ["a"])
+        del result.custom
+        self.assertNotIn("custom", result)
+
+    def test_json(self):
+        result = PluginResult(name="probe", status=1, results={"a": 1},
+                              custom="value")
+        decoded = json.loads(json.dumps(result))
+        self.assertEqual(decoded, dict(result))
+
+    def test_pickle(self):
+        result = PluginResult(name="probe", status=1, custom=[1, 2])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(result, protocol))
+            self.assertIsInstance(loaded, PluginResult)
+            self.assertEqual(loaded, result)
+            self.assertEqual(loaded.custom, [1, 2])
+
+    def test_copy(self):
+        result = PluginResult(name="probe", custom=1)
+        copy = result.copy()
+        self.assertIsInstance(copy, PluginResult)
+        self.assertEqual(copy, result)
+        copy.status = 0
+        self.assertEqual(result.status, -1)
+
+    def test_bytes_roundtrip(self):
+        result = PluginResult(name="probe", version="1", duration=1.5,
+                              status=0, results={"key": [1, "two"]},
+                              custom="value")
+        data = result.to_bytes()
+        self.assertIsInstance(data, bytes)
+        loaded = PluginResult.from_bytes(data)
+        self.assertIsInstance(loaded, PluginResult)
+        self.assertEqual(loaded, result)
+
+    def test_bytes_roundtrip_json(self):
+        msgpack = plugin_result.msgpack
+        plugin_result.msgpack = None
+        try:
+            result = PluginResult(name="probe", status=0, custom=1)
+            data = result.to_bytes()
+            self.assertEqual(data[:1], b'J')
+            self.assertEqual(PluginResult.from_bytes(data), result)
+        finally:
+            plugin_result.msgpack = msgpack
+
+    @unittest.skipIf(plugin_result.msgpack is None, "msgpack not installed")
+    def test_bytes_roundtrip_int_keys(self):
+        result = PluginResult(name="probe", status=1,
+                              results={1: "detected",
+                                       "nested": {2: [{3: None}], "a": []}})
+        self.assertEqual(PluginResult.from_bytes(result.to_bytes()), result)
+
+    def test_bytes_invalid(self):
+        self.assertRaises(ValueError, PluginResult.from_bytes, b'Xdata')
+
+
+class TestPluginResultAggregator(unittest.TestCase):
+
+    def test_probe_stats(self):
+        aggregator = PluginResultAggregator()
+        for duration in range(1, 101):
+            aggregator.add(PluginResult(name="probe", status=0,
+                                        duration=float(duration)))
+        aggregator.add(PluginResult(name="probe", status=-1,
+                                    error="failure"))
+        stats = aggregator.probe_stats("probe")
+        self.assertEqual(stats["count"], 101)
+        self.assertEqual(stats["status"], {0: 100, -1: 1})
+        self.assertEqual(stats["errors"], 1)
+        durations = stats["duration"]
+        self.assertEqual((durations["min"], durations["max"]), (1., 100.))
+        self.assertEqual(durations["mean"], 50.5)
+        self.assertEqual(durations["p50"], 51.)
+        self.assertEqual(durations["p90"], 90.)
+        self.assertEqual(aggregator.probes(), ["probe"])
+
+    def test_reservoir(self):
+        aggregator = PluginResultAggregator(reservoir_size=10)
+        for duration in range(1000):
+            aggregator.add({"name": "probe", "duration": duration})
+        stats = aggregator.probe_stats("probe")
+        self.assertEqual(stats["count"], 1000)
+        # exact bounds even when samples are dropped
+        self.assertEqual(stats["duration"]["max"], 999)
+        self.assertEqual(len(aggregator._probes["probe"].samples), 10)
+
+    def test_file_summary(self):
+        aggregator = PluginResultAggregator()
+        aggregator.extend([
+            ("clean", PluginResult(name="a", status=0)),
+            ("clean", PluginResult(name="b", status=-1, error="failure")),
+            ("detected", PluginResult(name="a", status=1)),
+            ("error", PluginResult(name="a", status=-1)),
+        ])
+        self.assertEqual(aggregator.files(), ["clean", "detected", "error"])
+        self.assertEqual(aggregator.file_summary("clean"),
+                         {"probes": 2, "errors": 1, "detections": 0,
+                          "verdict": "clean"})
+        self.assertEqual(aggregator.file_summary("detected")["verdict"],
+                         "detected")
+        self.assertEqual(aggregator.file_summary("error")["verdict"],
+                         "error")
+
+    def test_file_eviction(self):
+        evicted = []
+        aggregator = PluginResultAggregator(
+            max_files=2,
+            on_evict=lambda filename, summary: evicted.append(filename))
+        for filename in "abc":
+            aggregator.add(PluginResult(name="a", status=0), filename)
+        self.assertEqual(aggregator.files(), ["b", "c"])
+        self.assertEqual(evicted, ["a"])
+        self.assertEqual(aggregator.evicted, 1)
+
+
+if __name__ == '__main__':
+    enable_logging()
+    unittest.main()
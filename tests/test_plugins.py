@@ -0,0 +1,859 @@
+#
+# Copyright (c) 2013-2016 Quarkslab.
+# This file is part of IRMA project.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License in the top-level directory
+# of this distribution and at:
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# No part of the project, including this file, may be copied,
+# modified, propagated, or distributed except according to the
+# terms contained in the LICENSE file.
+
+import os
+import sys
+import stat
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+import types
+
+from importlib import import_module
+
+# plugins rely on relative imports of modules outside of their package,
+# import them through the package name of the repository
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if os.path.dirname(root) not in sys.path:
+    sys.path.insert(0, os.path.dirname(root))
+package = os.path.basename(root)
+plugins = import_module(package + ".plugins")
+plugin_result = import_module(package + ".plugin_result")
+which = import_module(package + ".plugins.which")
+
+PluginExecutor = plugins.PluginExecutor
+PluginInstancePool = plugins.PluginInstancePool
+IsolatedPluginRunner = plugins.IsolatedPluginRunner
+PluginManager = plugins.PluginManager
+PluginManifest = plugins.PluginManifest
+PluginMetrics = plugins.PluginMetrics
+timed = plugins.timed
+DependencyCache = plugins.DependencyCache
+Dependency = plugins.Dependency
+BinaryDependency = plugins.BinaryDependency
+PathIndex = which.PathIndex
+PluginResult = plugin_result.PluginResult
+
+
+# =================
+#  Logging options
+# =================
+
+def enable_logging(level=logging.INFO, handler=None, formatter=None):
+    global log
+    log = logging.getLogger()
+    if formatter is None:
+        formatter = logging.Formatter("%(asctime)s [%(name)s] " +
+                                      "%(levelname)s: %(message)s")
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+    log.setLevel(level)
+
+
+# ==============
+#  Test plugins
+# ==============
+
+class EchoPlugin(object):
+    plugin_name = "echo"
+    plugin_category = "test"
+    plugin_version = "1.0"
+    plugin_batch_size = None
+    plugin_dependencies = []
+    plugin_mimetype_regexp = None
+    plugin_active = True
+    delay = 0
+
+    def run(self, filename):
+        time.sleep(self.delay)
+        return filename
+
+
+class SlowPlugin(EchoPlugin):
+    plugin_name = "slow"
+    delay = 0.3
+
+
+class CountingPlugin(EchoPlugin):
+    plugin_name = "counting"
+    delay = 0.1
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+    instances = 0
+
+    def __init__(self):
+        with CountingPlugin.lock:
+            CountingPlugin.instances += 1
+
+    def run(self, filename):
+        with CountingPlugin.lock:
+            CountingPlugin.running += 1
+            CountingPlugin.peak = max(CountingPlugin.peak,
+                                      CountingPlugin.running)
+        try:
+            return super(CountingPlugin, self).run(filename)
+        finally:
+            with CountingPlugin.lock:
+                CountingPlugin.running -= 1
+
+    @classmethod
+    def reset(cls):
+        cls.running = cls.peak = cls.instances = 0
+
+
+class BatchPlugin(EchoPlugin):
+    plugin_name = "batch"
+    plugin_batch_size = 3
+    batches = []
+
+    def run(self, filename):
+        return filename.upper()
+
+    def run_batch(self, filenames):
+        if "bad" in filenames:
+            raise ValueError("bad file in batch")
+        BatchPlugin.batches.append(list(filenames))
+        return [filename.upper() for filename in filenames]
+
+
+class CrashPlugin(EchoPlugin):
+    plugin_name = "crash"
+
+    def run(self, filename):
+        if filename == "crash":
+            os._exit(1)
+        if filename == "hang":
+            time.sleep(10)
+        if filename == "undecodable":
+            return filename
+        return os.getpid()
+
+
+class CountingDependency(Dependency):
+    cache = DependencyCache()
+    checks = 0
+
+    def is_satisfied(self):
+        CountingDependency.checks += 1
+        return self.dependency_name != "missing"
+
+
+def make_plugin(name, dependencies=(), regexp=None):
+    attrs = {"plugin_name": name,
+             "plugin_canonical_name": "test_plugins." + name,
+             "plugin_dependencies": list(dependencies),
+             "plugin_mimetype_regexp": regexp,
+             "plugin_active": None}
+    return type(name, (EchoPlugin,), attrs)
+
+
+# ============
+#  Test Cases
+# ============
+
+class TestPluginManager(unittest.TestCase):
+
+    def setUp(self):
+        CountingDependency.cache.invalidate()
+        CountingDependency.checks = 0
+        self.registered = PluginManager._PluginManager__plugins_cls
+        self.saved = dict(self.registered)
+        self.registered.clear()
+        PluginManager.invalidate_mimetype_index()
+
+    def tearDown(self):
+        self.registered.clear()
+        self.registered.update(self.saved)
+        PluginManager.invalidate_mimetype_index()
+
+    def test_check_dependencies(self):
+        plugins = [make_plugin("plugin{0}".format(index),
+                               [CountingDependency("shared")])
+                   for index in range(10)]
+        results = PluginManager.check_dependencies(plugins, workers=4)
+        self.assertEqual(results, {("CountingDependency", "shared"): True})
+        self.assertEqual(CountingDependency.checks, 1)
+
+    def test_register_plugins(self):
+        found = make_plugin("found", [CountingDependency("found")])
+        missing = make_plugin("missing", [CountingDependency("found"),
+                                          CountingDependency("missing")])
+        failures = PluginManager.register_plugins([found, missing],
+                                                  workers=4)
+        self.assertEqual(list(failures), [missing])
+        self.assertEqual(failures[missing].dependency.dependency_name,
+                         "missing")
+        self.assertEqual(list(PluginManager().get_all_plugins()), [found])
+        self.assertTrue(found.plugin_active)
+        self.assertEqual(CountingDependency.checks, 2)
+
+    def test_mimetype(self):
+        plugins = [make_plugin("pe", regexp="PE32"),
+                   make_plugin("elf", regexp="^ELF"),
+                   make_plugin("backref", regexp=r"(ELF).*\1"),
+                   make_plugin("all")]
+        PluginManager.register_plugins(plugins)
+        manager = PluginManager()
+        selected = manager.get_plugins_for_mimetype("ELF 64-bit ELF")
+        self.assertEqual([plugin.plugin_name for plugin in selected],
+                         ["all", "backref", "elf"])
+        selected = manager.get_plugins_for_mimetype("MS-DOS PE32")
+        self.assertEqual([plugin.plugin_name for plugin in selected],
+                         ["all", "pe"])
+        selected = manager.get_plugins_for_mimetype(None)
+        self.assertEqual([plugin.plugin_name for plugin in selected],
+                         ["all"])
+
+    def test_mimetype_inactive(self):
+        plugin = make_plugin("elf", regexp="ELF")
+        PluginManager.register_plugins([plugin])
+        manager = PluginManager()
+        self.assertEqual(manager.get_plugins_for_mimetype("ELF"), [plugin])
+        plugin.plugin_active = False
+        PluginManager.invalidate_mimetype_index()
+        self.assertEqual(manager.get_plugins_for_mimetype("ELF"), [])
+
+    def test_mimetype_many_plugins(self):
+        # more groups than python 2 re supports in a single pattern
+        plugins = [make_plugin("plugin{0:03d}".format(index),
+                               regexp=r"(PE|ELF)(32)?{0}$".format(index))
+                   for index in range(150)]
+        plugins.append(make_plugin("all"))
+        PluginManager.register_plugins(plugins)
+        selected = PluginManager().get_plugins_for_mimetype("ELF32142")
+        self.assertEqual([plugin.plugin_name for plugin in selected],
+                         ["all", "plugin142"])
+
+
+
+PLUGIN_MODULE = """
+from {package}.plugins import PluginBase, BinaryDependency
+
+with open({log!r}, "a") as log:
+    log.write(__name__ + "\\n")
+
+
+class Plugin(PluginBase):
+    _plugin_name_ = "{name}"
+    _plugin_author_ = "test"
+    _plugin_version_ = "1.0"
+    _plugin_category_ = "test"
+    _plugin_dependencies_ = [BinaryDependency("{binary}")]
+"""
+
+
+class TestPluginManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_manifest")
+        self.path = os.path.join(self.tmpdir, "manifest.json")
+        self.module = os.path.join(self.tmpdir, "module.py")
+        with open(self.module, "w"):
+            pass
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_persistence(self):
+        manifest = PluginManifest(self.path)
+        missing = [{"plugin": "other", "dependency": ["BinaryDependency",
+                                                      "tool"]}]
+        manifest.update("pkg.module", self.module, ["plugin"],
+                        missing=missing)
+        manifest.save()
+        entry = PluginManifest(self.path).get("pkg.module", self.module)
+        self.assertEqual(entry["plugins"], ["plugin"])
+        self.assertIsNone(entry["error"])
+        self.assertEqual(entry["missing"], missing)
+
+    def test_modified_module(self):
+        manifest = PluginManifest(self.path)
+        manifest.update("pkg.module", self.module, [], error="failure")
+        mtime = os.path.getmtime(self.module) + 1
+        os.utime(self.module, (mtime, mtime))
+        self.assertIsNone(manifest.get("pkg.module", self.module))
+        self.assertIsNone(manifest.get("pkg.other", self.module))
+
+    def test_remove(self):
+        manifest = PluginManifest(self.path)
+        manifest.update("pkg.module", self.module, ["plugin"])
+        manifest.save()
+        manifest.remove("pkg.module")
+        manifest.save()
+        self.assertIsNone(PluginManifest(self.path).get("pkg.module",
+                                                        self.module))
+
+    def test_other_version(self):
+        with open(self.path, "w") as manifest:
+            manifest.write('{"version": 1, "modules": {"pkg.module": {}}}')
+        self.assertIsNone(PluginManifest(self.path).get("pkg.module",
+                                                        self.module))
+
+    def test_invalid(self):
+        with open(self.path, "w") as manifest:
+            manifest.write("{")
+        self.assertIsNone(PluginManifest(self.path).get("pkg.module",
+                                                        self.module))
+
+
+class TestPluginDiscovery(unittest.TestCase):
+
+    prefix = "test_discovery"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_discovery")
+        self.modules = os.path.join(self.tmpdir, "modules")
+        self.bin = os.path.join(self.tmpdir, "bin")
+        os.mkdir(self.modules)
+        os.mkdir(self.bin)
+        self.manifest = os.path.join(self.tmpdir, "manifest.json")
+        self.log = os.path.join(self.tmpdir, "imports.log")
+        self.path = os.environ.get("PATH", "")
+        os.environ["PATH"] = self.bin
+        self.registered = PluginManager._PluginManager__plugins_cls
+        self.saved = dict(self.registered)
+        # parent package of the discovered modules
+        parent = types.ModuleType(self.prefix)
+        parent.__path__ = [self.modules]
+        sys.modules[self.prefix] = parent
+        self.create_module("alpha", "sh")
+        self.create_module("beta", "sh")
+        self.create_module("gamma", "tool")
+        self.create_binary("sh")
+
+    def tearDown(self):
+        self.unload()
+        del sys.modules[self.prefix]
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.tmpdir)
+        BinaryDependency.cache.invalidate()
+
+    def create_module(self, name, binary):
+        filename = os.path.join(self.modules, name + ".py")
+        with open(filename, "w") as module:
+            module.write(PLUGIN_MODULE.format(package=package, name=name,
+                                              binary=binary, log=self.log))
+
+    def create_binary(self, name):
+        filename = os.path.join(self.bin, name)
+        with open(filename, "w"):
+            pass
+        os.chmod(filename, 0o755)
+        # make sure directory modification is noticed
+        mtime = os.stat(self.bin).st_mtime + 1
+        os.utime(self.bin, (mtime, mtime))
+
+    def unload(self):
+        """Forget discovered modules, as a new process would"""
+        for name in list(sys.modules):
+            if name.startswith(self.prefix + "."):
+                del sys.modules[name]
+        self.registered.clear()
+        self.registered.update(self.saved)
+        PluginManager.invalidate_mimetype_index()
+        BinaryDependency.cache.invalidate()
+        which._PATH_INDEX.invalidate()
+
+    def discover(self, **kwargs):
+        """Return names of the imported modules and registered plugins"""
+        self.unload()
+        with open(self.log, "w"):
+            pass
+        PluginManager().discover(self.modules, self.prefix,
+                                 manifest=self.manifest, **kwargs)
+        with open(self.log) as log:
+            imported = [name[len(self.prefix) + 1:]
+                        for name in log.read().split()]
+        registered = [plugin.plugin_name for plugin in self.registered.values()
+                      if plugin.__module__.startswith(self.prefix + ".")]
+        return sorted(imported), sorted(registered)
+
+    def test_requested_plugins(self):
+        for workers in (None, 2):
+            if os.path.exists(self.manifest):
+                os.remove(self.manifest)
+            self.assertEqual(self.discover(workers=workers),
+                             (["alpha", "beta", "gamma"], ["alpha", "beta"]))
+            self.assertEqual(self.discover(plugins=["alpha"],
+                                           workers=workers),
+                             (["alpha"], ["alpha"]))
+
+    def test_missing_dependency(self):
+        for workers in (None, 2):
+            if os.path.exists(self.manifest):
+                os.remove(self.manifest)
+            self.discover(workers=workers)
+            entry = PluginManifest(self.manifest).get(
+                self.prefix + ".gamma", os.path.join(self.modules,
+                                                     "gamma.py"))
+            self.assertEqual(entry["missing"],
+                             [{"plugin": "gamma",
+                               "dependency": ["BinaryDependency", "tool"]}])
+            # not imported again while the dependency is missing
+            self.assertEqual(self.discover(workers=workers),
+                             (["alpha", "beta"], ["alpha", "beta"]))
+            self.create_binary("tool")
+            self.assertEqual(self.discover(plugins=["alpha"],
+                                           workers=workers),
+                             (["alpha"], ["alpha"]))
+            self.assertEqual(self.discover(plugins=["gamma"],
+                                           workers=workers),
+                             (["gamma"], ["gamma"]))
+            os.remove(os.path.join(self.bin, "tool"))
+
+
+class TestPathIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.environ.get("PATH", "")
+        self.tmpdir = tempfile.mkdtemp(prefix="test_path_index")
+        os.environ["PATH"] = self.tmpdir
+        BinaryDependency.cache.invalidate()
+
+    def tearDown(self):
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.tmpdir)
+        BinaryDependency.cache.invalidate()
+
+    def create(self, name, mode=0o755):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, "w"):
+            pass
+        os.chmod(filename, mode)
+        # make sure directory modification is noticed
+        mtime = os.stat(self.tmpdir).st_mtime + 1
+        os.utime(self.tmpdir, (mtime, mtime))
+        return filename
+
+    def test_which(self):
+        index = PathIndex(ttl=0)
+        filename = self.create("program")
+        self.assertEqual(index.which("program"), filename)
+        self.assertEqual(index.which("program"), which.which("program"))
+        self.assertIsNone(index.which("missing"))
+
+    def test_not_executable(self):
+        index = PathIndex(ttl=0)
+        self.create("program", stat.S_IRUSR | stat.S_IWUSR)
+        self.assertIsNone(index.which("program"))
+
+    def test_directory_change(self):
+        index = PathIndex(ttl=0)
+        self.assertIsNone(index.which("program"))
+        filename = self.create("program")
+        self.assertEqual(index.which("program"), filename)
+
+    def test_ttl(self):
+        index = PathIndex(ttl=60)
+        self.assertIsNone(index.which("program"))
+        filename = self.create("program")
+        # directories are not checked again before ttl expiration
+        self.assertIsNone(index.which("program"))
+        index.invalidate()
+        self.assertEqual(index.which("program"), filename)
+
+    def test_pathext(self):
+        pathext = os.environ.get("PATHEXT")
+        os.environ["PATHEXT"] = os.pathsep.join([".COM", ".EXE"])
+        try:
+            index = PathIndex(case_sensitive=False, ttl=0)
+            filename = self.create("Program.exe")
+            self.assertEqual(index.which("program"), filename)
+        finally:
+            if pathext is None:
+                del os.environ["PATHEXT"]
+            else:
+                os.environ["PATHEXT"] = pathext
+
+    def test_windows_current_directory(self):
+        cwd = os.getcwd()
+        platform = sys.platform
+        index = PathIndex(ttl=0)
+        os.environ["PATH"] = ""
+        self.create("program")
+        os.chdir(self.tmpdir)
+        sys.platform = "win32"
+        try:
+            self.assertEqual(index.which("program"), "program")
+        finally:
+            sys.platform = platform
+            os.chdir(cwd)
+        self.assertIsNone(index.which("program"))
+
+    def test_binary_dependency(self):
+        self.create("program")
+        self.assertTrue(BinaryDependency("program").satisfied())
+        self.assertFalse(BinaryDependency("missing").satisfied())
+
+    def test_binary_dependency_list(self):
+        self.create("program")
+        self.assertTrue(BinaryDependency(["missing", "program"]).satisfied())
+        self.assertFalse(BinaryDependency(["missing", "other"]).satisfied())
+
+
+
+class ExpiringDependency(CountingDependency):
+    cache = DependencyCache(ttl=0.2)
+
+
+class TestDependencyCache(unittest.TestCase):
+
+    def setUp(self):
+        ExpiringDependency.cache.invalidate()
+        CountingDependency.checks = 0
+
+    def test_cache(self):
+        cache = DependencyCache(ttl=None)
+        self.assertIsNone(cache.get("key"))
+        cache.set("key", False)
+        self.assertFalse(cache.get("key"))
+        cache.invalidate("key")
+        self.assertIsNone(cache.get("key"))
+
+    def test_ttl(self):
+        cache = DependencyCache(ttl=0.1)
+        cache.set("key", True)
+        self.assertTrue(cache.get("key"))
+        time.sleep(0.2)
+        self.assertIsNone(cache.get("key"))
+
+    def test_shared_results(self):
+        self.assertTrue(ExpiringDependency("found").satisfied())
+        self.assertTrue(ExpiringDependency("found").satisfied())
+        self.assertFalse(ExpiringDependency("missing").satisfied())
+        self.assertEqual(CountingDependency.checks, 2)
+        # negative results expire too
+        time.sleep(0.3)
+        self.assertFalse(ExpiringDependency("missing").satisfied())
+        self.assertEqual(CountingDependency.checks, 3)
+
+    def test_invalidate(self):
+        dependency = ExpiringDependency("found")
+        dependency.satisfied()
+        dependency.invalidate()
+        dependency.satisfied()
+        self.assertEqual(CountingDependency.checks, 2)
+
+
+
+class TestPluginExecutor(unittest.TestCase):
+
+    def setUp(self):
+        CountingPlugin.reset()
+
+    def test_results(self):
+        with PluginExecutor(workers=2) as executor:
+            results = list(executor.map([EchoPlugin], ["a", "b"]))
+        self.assertEqual([filename for filename, _ in results], ["a", "b"])
+        for filename, result in results:
+            self.assertEqual(result.status, 0)
+            self.assertEqual(result.results, filename)
+            self.assertEqual(result.name, "echo")
+            self.assertIsNotNone(result.duration)
+
+    def test_plugin_error(self):
+        class FailingPlugin(EchoPlugin):
+            def run(self, filename):
+                raise ValueError("failure")
+        with PluginExecutor(workers=1) as executor:
+            result = executor.submit(FailingPlugin, "a").get()
+        self.assertEqual(result.status, -1)
+        self.assertEqual(result.error, "failure")
+
+    def test_timeout_from_execution_start(self):
+        # waiting for the single worker does not count in the timeout
+        with PluginExecutor(workers=1, timeout=1) as executor:
+            calls = [executor.submit(SlowPlugin, filename)
+                     for filename in "abcd"]
+            statuses = [call.get().status for call in calls]
+        self.assertEqual(statuses, [0] * 4)
+
+    def test_timeout(self):
+        with PluginExecutor(workers=1, timeout=0.1) as executor:
+            result = executor.submit(SlowPlugin, "a").get()
+        self.assertEqual(result.status, -1)
+        self.assertIn("timeout", result.error)
+
+    def test_process_mode(self):
+        with PluginExecutor(workers=2, mode="process",
+                            timeout=5) as executor:
+            results = list(executor.map([EchoPlugin], ["a", "b"]))
+        self.assertEqual([result.results for _, result in results],
+                         ["a", "b"])
+
+    def test_max_concurrency(self):
+        with PluginExecutor(workers=6,
+                            max_concurrency={"counting": 2}) as executor:
+            results = list(executor.map([CountingPlugin], "abcdef"))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(CountingPlugin.peak, 2)
+
+
+    def test_instance_pool(self):
+        pool = PluginInstancePool(size=1)
+        with PluginExecutor(workers=2, instance_pool=pool) as executor:
+            results = list(executor.map([CountingPlugin], "abcd"))
+        self.assertEqual([result.status for _, result in results], [0] * 4)
+        self.assertEqual(CountingPlugin.instances, 1)
+
+    def test_batch(self):
+        BatchPlugin.batches = []
+        with PluginExecutor(workers=2) as executor:
+            results = executor.submit_batch(BatchPlugin, ["a", "b"]).get()
+        self.assertEqual([result.results for result in results], ["A", "B"])
+        self.assertEqual(BatchPlugin.batches, [["a", "b"]])
+
+    def test_batch_fallback(self):
+        with PluginExecutor(workers=2) as executor:
+            call = executor.submit_batch(BatchPlugin, ["a", "bad", "c"])
+            results = call.get()
+        self.assertEqual([result.results for result in results],
+                         ["A", "BAD", "C"])
+        self.assertEqual([result.status for result in results], [0] * 3)
+
+    def test_map_batches(self):
+        BatchPlugin.batches = []
+        filenames = ["f{0}".format(index) for index in range(7)]
+        with PluginExecutor(workers=2, batch_latency=10) as executor:
+            results = list(executor.map([BatchPlugin], filenames))
+        self.assertEqual([filename for filename, _ in results], filenames)
+        self.assertEqual([result.results for _, result in results],
+                         [filename.upper() for filename in filenames])
+        self.assertEqual([len(batch) for batch in BatchPlugin.batches],
+                         [3, 3, 1])
+
+    def test_map_batch_latency(self):
+        BatchPlugin.batches = []
+
+        def filenames():
+            yield "a"
+            time.sleep(0.5)
+            # the first batch has been sent meanwhile
+            self.assertEqual(BatchPlugin.batches, [["a"]])
+            yield "b"
+        with PluginExecutor(workers=2, batch_latency=0.1) as executor:
+            results = list(executor.map([BatchPlugin], filenames()))
+        self.assertEqual([result.results for _, result in results],
+                         ["A", "B"])
+
+
+class TestPluginInstancePool(unittest.TestCase):
+
+    def setUp(self):
+        CountingPlugin.reset()
+
+    def test_reuse(self):
+        pool = PluginInstancePool(size=1)
+        with pool.instance(CountingPlugin) as first:
+            pass
+        with pool.instance(CountingPlugin) as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(CountingPlugin.instances, 1)
+
+    def test_max_uses(self):
+        pool = PluginInstancePool(size=1, max_uses=2)
+        instances = []
+        for _ in range(4):
+            with pool.instance(CountingPlugin) as instance:
+                instances.append(instance)
+        self.assertIs(instances[0], instances[1])
+        self.assertIsNot(instances[1], instances[2])
+        self.assertIs(instances[2], instances[3])
+        self.assertEqual(CountingPlugin.instances, 2)
+
+    def test_max_memory_growth(self):
+        pool = PluginInstancePool(size=1, max_memory_growth=2 ** 20)
+        with pool.instance(CountingPlugin) as first:
+            # grow the process memory while the instance is in use
+            data = b"x" * (8 * 2 ** 20)
+        with pool.instance(CountingPlugin) as second:
+            pass
+        del data
+        self.assertIsNot(first, second)
+
+    def test_discard_on_error(self):
+        pool = PluginInstancePool(size=1)
+        with self.assertRaises(ValueError):
+            with pool.instance(CountingPlugin):
+                raise ValueError()
+        with pool.instance(CountingPlugin):
+            pass
+        self.assertEqual(CountingPlugin.instances, 2)
+
+    def test_warm(self):
+        pool = PluginInstancePool(size=3)
+        pool.warm(CountingPlugin)
+        self.assertEqual(CountingPlugin.instances, 3)
+        with pool.instance(CountingPlugin):
+            pass
+        self.assertEqual(CountingPlugin.instances, 3)
+
+    def test_size(self):
+        pool = PluginInstancePool(size=2)
+        first = pool.acquire(CountingPlugin)
+        second = pool.acquire(CountingPlugin)
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(pool.acquire(CountingPlugin)))
+        thread.start()
+        thread.join(0.2)
+        # blocks while all instances are busy
+        self.assertEqual(acquired, [])
+        pool.release(CountingPlugin, first)
+        thread.join()
+        self.assertEqual(acquired, [first])
+        pool.release(CountingPlugin, second)
+        self.assertEqual(CountingPlugin.instances, 2)
+
+
+
+class TestIsolatedPluginRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.from_bytes = PluginResult.__dict__["from_bytes"]
+        from_bytes = self.from_bytes.__func__
+
+        def undecodable(cls, data):
+            # results of the file named "undecodable" can not be decoded
+            result = from_bytes(cls, data)
+            if result.results == "undecodable":
+                raise ValueError("invalid data")
+            return result
+        PluginResult.from_bytes = classmethod(undecodable)
+
+    def tearDown(self):
+        PluginResult.from_bytes = self.from_bytes
+
+    def test_worker_reused(self):
+        with IsolatedPluginRunner(CrashPlugin) as runner:
+            pids = [runner.run("a").results for _ in range(3)]
+        self.assertEqual(len(set(pids)), 1)
+        self.assertNotEqual(pids[0], os.getpid())
+
+    def test_crash_respawn(self):
+        with IsolatedPluginRunner(CrashPlugin) as runner:
+            pid = runner.run("a").results
+            crashed = runner.run("crash")
+            respawned = runner.run("a")
+        self.assertEqual(crashed.status, -1)
+        self.assertIn("exited with code 1", crashed.error)
+        self.assertEqual(respawned.status, 0)
+        self.assertNotEqual(respawned.results, pid)
+
+    def test_timeout_respawn(self):
+        with IsolatedPluginRunner(CrashPlugin, timeout=0.2) as runner:
+            pid = runner.run("a").results
+            timed_out = runner.run("hang")
+            respawned = runner.run("a")
+        self.assertEqual(timed_out.status, -1)
+        self.assertIn("timeout", timed_out.error)
+        self.assertEqual(respawned.status, 0)
+        self.assertNotEqual(respawned.results, pid)
+
+    def test_undecodable_result(self):
+        with IsolatedPluginRunner(CrashPlugin) as runner:
+            pid = runner.run("a").results
+            undecodable = runner.run("undecodable")
+            result = runner.run("a")
+        self.assertEqual(undecodable.status, -1)
+        self.assertIn("undecodable result", undecodable.error)
+        # the worker is still usable
+        self.assertEqual(result.results, pid)
+
+    def test_executor_isolation(self):
+        with PluginExecutor(workers=2, isolate=["crash"]) as executor:
+            results = list(executor.map([CrashPlugin],
+                                        ["a", "crash", "undecodable", "b"]))
+        self.assertEqual([result.status for _, result in results],
+                         [0, -1, -1, 0])
+
+
+
+class TimedPlugin(EchoPlugin):
+    plugin_name = "timed"
+
+    @timed
+    def run(self, filename):
+        if filename == "error":
+            raise ValueError("failure")
+        # burn some CPU
+        sum(range(10 ** 5))
+        time.sleep(0.05)
+        if filename == "raw":
+            return filename
+        return PluginResult(status=0, results=filename)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        PluginMetrics().reset()
+
+    def test_result(self):
+        result = TimedPlugin().run("a")
+        self.assertEqual(result.results, "a")
+        self.assertGreaterEqual(result.duration, 50)
+        if sys.platform.startswith("linux"):
+            self.assertGreater(result.cpu_time, 0)
+            self.assertLess(result.cpu_time, result.duration)
+            self.assertIsNotNone(result.rss_delta)
+
+    def test_not_a_result(self):
+        self.assertEqual(TimedPlugin().run("raw"), "raw")
+        self.assertEqual(PluginMetrics().dump()["timed"]["calls"], 1)
+
+    def test_metrics(self):
+        plugin = TimedPlugin()
+        durations = [plugin.run(filename).duration for filename in "ab"]
+        with self.assertRaises(ValueError):
+            plugin.run("error")
+        metrics = PluginMetrics().dump()["timed"]
+        self.assertEqual(metrics["calls"], 3)
+        self.assertEqual(metrics["errors"], 1)
+        self.assertGreaterEqual(metrics["duration_total"], sum(durations))
+        self.assertLessEqual(metrics["duration_min"], min(durations))
+        self.assertEqual(metrics["duration_max"], max(durations))
+        PluginMetrics().reset()
+        self.assertEqual(PluginMetrics().dump(), {})
+
+    def test_thread_cpu_time(self):
+        if not sys.platform.startswith("linux"):
+            self.skipTest("per thread CPU time not available")
+        stop = threading.Event()
+
+        def burn():
+            while not stop.is_set():
+                pass
+        thread = threading.Thread(target=burn)
+        thread.start()
+        try:
+            result = TimedPlugin().run("a")
+        finally:
+            stop.set()
+            thread.join()
+        # CPU used by the other thread is not accounted
+        self.assertLess(result.cpu_time, result.duration / 2)
+
+
+if __name__ == '__main__':
+    enable_logging()
+    unittest.main()
@@ -16,6 +16,9 @@
 import logging
 import unittest
 import os
+import hashlib
+from tempfile import TemporaryFile
+from irma.common.exceptions import IrmaSFTPError
 from irma.ftp.sftp import IrmaSFTP
 from tests.test_ftps import FTPSTestCase
 
@@ -62,6 +65,49 @@ class SFTPTestCase(FTPSTestCase):
         # do the teardown
         self.flush_all()
 
+class FakeSFTPClient(object):
+    """SFTPClient serving one file, written by chunks as getfo does"""
+
+    def __init__(self, data, chunk_size=4):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def getfo(self, remotepath, fl):
+        for i in range(0, len(self.data), self.chunk_size):
+            fl.write(self.data[i:i + self.chunk_size])
+        return len(self.data)
+
+
+class OfflineSFTP(IrmaSFTP):
+
+    def _connect(self):
+        self._client = FakeSFTPClient(self.data)
+
+    def _hash(self, fobj):
+        raise AssertionError("downloaded file read again")
+
+
+class CheckSFTPDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.data = "TEST TEST TEST TEST"
+        OfflineSFTP.data = self.data
+        self.ftp = OfflineSFTP("irma.test", 22022, "testuser", "testpwd")
+
+    def test_download_fobj_hashed_during_transfer(self):
+        t = TemporaryFile()
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.ftp.download_fobj(".", digest, t)
+        self.assertEqual(t.read(), self.data)
+        t.close()
+
+    def test_download_fobj_integrity(self):
+        t = TemporaryFile()
+        with self.assertRaises(IrmaSFTPError):
+            self.ftp.download_fobj(".", "0" * 64, t)
+        t.close()
+
+
 if __name__ == '__main__':
     enable_logging()
     unittest.main()